@@ -11,24 +11,32 @@ own local interfaces
 """
 
 
+import os
 import logging
+import asyncore
 
 from math import pi
 from time import time, sleep
 from struct import Struct, pack, unpack, calcsize
 from SocketServer import ThreadingTCPServer, BaseRequestHandler
 from threading import Thread, RLock, Event
-from Queue import Queue
+from Queue import Queue, Empty
+from select import select
+from collections import deque
 from socket import error as SocketError
 from socket import timeout as SocketTimeout
 from socket import (
     socket, AF_INET, SOCK_STREAM, SOCK_DGRAM,
     SOL_SOCKET, SO_REUSEADDR, SHUT_RDWR, 
+    IPPROTO_IP, IP_MULTICAST_TTL, IP_MULTICAST_LOOP,
+    IP_ADD_MEMBERSHIP, INADDR_ANY, inet_aton,
     )
 
 from numpy import array as narray
 
 from phringes.core.macros import parse_includes
+from phringes.core.executor import BoundedExecutor
+from phringes.core.metrics import timings
 from phringes.core.loggers import (
     debug, info, warning, 
     critical, error,
@@ -36,9 +44,13 @@ from phringes.core.loggers import (
 
 
 __all__ = [ 'K', 'BYTE', 'SBYTE', 'FLOAT',
-            'MAX_REQUEST_SIZE',
+            'MAX_REQUEST_SIZE', 'MAX_EXTENDED_REQUEST',
+            'PICKLE_PACKET_VERSION', 'BINARY_PACKET_VERSION',
+            'STAGE_TIMES_FLAG',
             'BasicCorrelationProvider',
+            'ProviderFrame',
             'BasicRequestHandler',
+            'BasicAsyncChannel',
             'BasicTCPServer',
             ]
 
@@ -51,30 +63,97 @@ SBYTE = Struct('!b')
 SBYTE_SIZE = SBYTE.size
 SHORT = Struct('!H')
 SHORT_SIZE = SHORT.size
+LONG = Struct('!I')
+LONG_SIZE = LONG.size
+MAX_SHORT_FRAME = 0xffff # largest frame a SHORT size can describe
+EXTENDED_HEADER_SIZE = SHORT_SIZE + LONG_SIZE # SHORT 0 marker + LONG size
+MAX_EXTENDED_REQUEST = 16 * 2**20 # largest extended request a server accepts
 FLOAT = Struct('!f')
 FLOAT_SIZE = FLOAT.size
+METRIC = Struct('!II6f') # calls, timed, mean, p50, p90, p99, p99.9, max (ms)
+METRIC_FIELDS = ('calls', 'timed', 'mean', 'p50', 'p90', 'p99', 'p99.9', 'max')
+PICKLE_PACKET_VERSION = 1 # header + pickled numpy arrays
+BINARY_PACKET_VERSION = 2 # versioned header + raw big-endian payload
+STAGE_TIMES_FLAG = 0x01 # binary packet ends with the provider's stage times
+
+
+def extended_header(length):
+    """ extended_header(length) -> header
+    Returns the header of an extended frame carrying 'length' bytes, a SHORT
+    size of 0 (never valid for a short frame) followed by the LONG size of
+    the whole frame."""
+    return SHORT.pack(0) + LONG.pack(length + EXTENDED_HEADER_SIZE)
 
 
 class BasicCorrelationProvider:
     """ Generates appropriate correlations using parameters
     from a BasicTCPServer instance and sends out one UDP
-    data packet per baseline to a list of subscribers."""
+    data packet per baseline to a list of subscribers.
+
+    Every subscriber receives packets of the version it negotiated
+    when subscribing, the header of the original (pickled) version is
+    inst._header_struct:
+
+    corr_time : left  : right : current : total
+    Double    : UByte : UByte : UByte   : UByte
+
+    and the header of the binary version is inst._binary_header_struct:
+
+    version : flags : corr_time : left  : right : current : total : lags
+    UByte   : UByte : Double    : UByte : UByte : UByte   : UByte : UShort
+
+    If the provider timed the stages of the integration (inst._stage_times)
+    the binary packets have STAGE_TIMES_FLAG set in their flags and end
+    with inst._stage_struct, the UNIX times at which
+
+    dumped : seen   : read   : processed : sent
+    Double : Double : Double : Double    : Double
+
+    the integration finished, the provider noticed it, read it, finished
+    processing it and built the packet. Decoders that do not know about
+    the trailer simply ignore it.
+
+    Reading out the correlations and broadcasting them run on separate
+    threads: the readout thread copies every integration into a free
+    ProviderFrame of a small preallocated ring and the broadcast thread
+    sends the frames in order. When the broadcast falls so far behind that
+    no frame is free, the oldest unsent one is dropped and counted in
+    inst.overruns.
+
+    Subclasses list the versions they can produce in _packet_versions."""
 
     _header_struct = Struct('!dBBBB')
     _header_size = _header_struct.size
+    _binary_header_struct = Struct('!BBdBBBBH')
+    _binary_header_size = _binary_header_struct.size
+    _stage_struct = Struct('!5d')
+    _stage_size = _stage_struct.size
+    _stages = ('dumped', 'seen', 'read', 'processed', 'sent')
+    _packet_versions = (PICKLE_PACKET_VERSION,)
 
     @debug
-    def __init__(self, server, include_baselines, lags=32):
-        """ BasicCorrelationProvider(server, include, lags=32) -> inst
+    def __init__(self, server, include_baselines, lags=32, ring_size=4):
+        """ BasicCorrelationProvider(server, include, lags=32, ring_size=4) -> inst
         Returns an instance and requires a BasicTCPServer as the
-        first argument."""
+        first argument, 'ring_size' (at least 2) is the number of frames
+        between the readout and the broadcast."""
         self.server = server
-        self.subscribers = set()
+        self.subscribers = {} # address -> packet version
+        self.subscriber_stats = {} # address -> send counters
+        self.multicast_group = None
+        self._udp_sock = socket(AF_INET, SOCK_DGRAM)
         self._stopevent = Event()
         self._lags = lags
         self._correlations = {}
         self._last_correlation = time()
+        self._stage_times = None # (dumped, seen, read, processed) of the last dump
         self._include_baselines = include_baselines
+        self._ring_size = max(2, ring_size)
+        self._free_frames = None
+        self._ready_frames = None
+        self.frames_captured = 0
+        self.frames_broadcast = 0
+        self.overruns = 0
         self.logger = logging.getLogger(self.__class__.__name__)
 
     @debug
@@ -83,46 +162,158 @@ class BasicCorrelationProvider:
         Checks if the given address is a subscriber."""
         return address in self.subscribers
     
+    @debug
+    def negotiate_version(self, requested):
+        """ inst.negotiate_version(requested) -> version
+        Returns the newest packet version this provider can produce
+        that is not newer than the requested one."""
+        supported = [v for v in self._packet_versions if v <= requested]
+        if supported:
+            return max(supported)
+        return min(self._packet_versions)
+
     @info
-    def add_subscriber(self, address):
-        """ inst.add_subscriber(address) -> None
+    def add_subscriber(self, address, version=PICKLE_PACKET_VERSION):
+        """ inst.add_subscriber(address, version=1) -> version
         Adds the given address to the list of subscribers. This means
         that UDP data packets will be sent there once the correlator
-        is started."""
-        self.subscribers.add(address)
+        is started. Returns the packet version it will be sent."""
+        version = self.negotiate_version(version)
+        self.subscribers[address] = version
+        self.subscriber_stats[address] = {'packets': 0, 'bytes': 0,
+                                          'errors': 0, 'last_error': None}
+        return version
 
     @info
     def remove_subscriber(self, address):
         """ inst.remove_subscriber(address) -> None
         Removes the given address from the list of subscribers; i.e.
         it will no longer be sent UDP data packets."""
-        self.subscribers.remove(address)
+        del self.subscribers[address]
+        self.subscriber_stats.pop(address, None)
+
+    @info
+    def set_multicast(self, group, version=BINARY_PACKET_VERSION, ttl=1, loopback=True):
+        """ inst.set_multicast(group=(ip, port), version=2, ttl=1, loopback=True) -> version
+        Publishes every correlation packet once to the given IP multicast
+        group instead of (or on top of) unicasting a copy to each
+        subscriber, monitors then simply join the group (see BasicUDPClient).
+        The group is treated as one more subscriber so it shows up in
+        inst.get_subscriber_stats. 'loopback' lets clients on this host
+        receive the packets too."""
+        if self.multicast_group is not None:
+            self.remove_subscriber(self.multicast_group)
+        self._udp_sock.setsockopt(IPPROTO_IP, IP_MULTICAST_TTL, ttl)
+        self._udp_sock.setsockopt(IPPROTO_IP, IP_MULTICAST_LOOP, int(loopback))
+        self.multicast_group = group
+        return self.add_subscriber(group, version)
+
+    @debug
+    def get_subscriber_stats(self):
+        """ inst.get_subscriber_stats() -> {address: counters, ...}
+        Returns a copy of the per-subscriber send counters, i.e. the
+        number of packets and bytes sent, the number of failed sends and
+        the last error, useful for spotting dead or slow subscribers."""
+        return dict((a, c.copy()) for a, c in self.subscriber_stats.items())
 
     @debug
     def _process(self):
         self.correlate() # reads the lags
 
+    def _new_frame(self):
+        """ Returns an empty frame for the ring, subclasses keeping their
+        correlations in other members should preallocate them here."""
+        return ProviderFrame()
+
+    def _capture(self, frame):
+        """ Copies the last integration into 'frame', reusing its arrays
+        once they have the right shape."""
+        for baseline, correlation in self._correlations.iteritems():
+            buf = frame.data.get(baseline)
+            if buf is None or buf.shape != correlation.shape or buf.dtype != correlation.dtype:
+                frame.data[baseline] = correlation.copy()
+            else:
+                buf[...] = correlation
+
     @debug
     def _provider_loop(self):
         """ Started in a separate thread by inst.start() and runs 
         until inst._stopevent is set by inst.stop(). It can be
         restarted by calling inst.start().
         
-        This loop/thread does all the work. It tracks the time of every
-        correlation, calls inst.correlate() and broadcasts the data to
-        subscribers via inst.broadcast(), and the waits until the next
-        appropriate time to correlate given an integration time.
+        This loop/thread reads out every integration, it calls
+        inst._process() (which waits for and correlates the next one)
+        and hands a copy of the result to the broadcast thread (see
+        inst._broadcast_loop) through the ring of frames.
         """
         while not self._stopevent.isSet():
-            with RLock():
-                self.broadcast()
             self._process()
+            if self._stopevent.isSet():
+                return
+            try:
+                frame = self._free_frames.get_nowait()
+            except Empty:
+                try: # drop the oldest frame nobody has sent yet
+                    frame = self._ready_frames.get_nowait()
+                except Empty: # it was just picked up, one is free again
+                    frame = self._free_frames.get()
+                else:
+                    self.overruns += 1
+                    self.logger.warning('broadcast overrun, dropped the integration at %f'
+                                        % frame.corr_time)
+            frame.corr_time = self._last_correlation
+            frame.stage_times = self._stage_times
+            self._capture(frame)
+            self.frames_captured += 1
+            self._ready_frames.put(frame)
 
     @debug
-    def _data_iter(self):
-        for baseline, correlation in self._correlations.iteritems():
+    def _broadcast_loop(self, period=0.5):
+        """ Started next to the provider loop by inst.start(), sends every
+        frame the readout hands over (waking up at least every 'period'
+        seconds to check for a stop) and puts it back in the ring."""
+        while not self._stopevent.isSet():
+            try:
+                frame = self._ready_frames.get(timeout=period)
+            except Empty:
+                continue
+            try:
+                self.broadcast(frame)
+            finally:
+                self.frames_broadcast += 1
+                self._free_frames.put(frame)
+
+    @debug
+    def _data_iter(self, frame, version=PICKLE_PACKET_VERSION):
+        for baseline, correlation in frame.data.iteritems():
             yield baseline, correlation.dumps()
 
+    @debug
+    def _packet_iter(self, frame, version=PICKLE_PACKET_VERSION):
+        """ Yields one packet (header and data) per baseline of the frame
+        in the requested version."""
+        current = 0
+        total = len(self._include_baselines)
+        flags, trailer = 0, ''
+        if frame.stage_times is not None and version != PICKLE_PACKET_VERSION:
+            flags = STAGE_TIMES_FLAG
+            trailer = self._stage_struct.pack(*(frame.stage_times + (time(),)))
+        for baseline, data in self._data_iter(frame, version):
+            if version == PICKLE_PACKET_VERSION:
+                header = self._header_struct.pack(
+                    frame.corr_time,
+                    baseline[0], baseline[1],
+                    current, total
+                    )
+            else:
+                header = self._binary_header_struct.pack(
+                    version, flags, frame.corr_time,
+                    baseline[0], baseline[1],
+                    current, total, self._lags
+                    )
+            current += 1
+            yield header + data + trailer
+
     @info
     def correlate(self):
         """ inst.correlate() -> None
@@ -139,45 +330,98 @@ class BasicCorrelationProvider:
             self._correlations[baseline] = narray([0]*self._lags*2)
 
     @info
-    def broadcast(self):
-        """ inst.broadcast() -> None
-        Constructs UDP packets and sends one packet per baseline per
-        subscriber."""
-        current = 0
-        total = len(self._include_baselines)
-        self.logger.info('new correlation at %f' % self._last_correlation)
-        for baseline, data in self._data_iter():
-            header = self._header_struct.pack(
-                self._last_correlation,
-                baseline[0], baseline[1],
-                current, total
-                )
-            current += 1
-            pkt = header + data
-            pkt_len = len(pkt) + SHORT_SIZE
-            self.logger.debug('packet: %r' % pkt)
-            self.logger.debug('sending {0} bytes of data, {1} bytes total'.format(len(data), pkt_len))
-            for subscriber in self.subscribers:
-                udp_sock = socket(AF_INET, SOCK_DGRAM)
-                udp_sock.sendto(SHORT.pack(pkt_len)+pkt, subscriber)
-                udp_sock.close()
+    def broadcast(self, frame):
+        """ inst.broadcast(frame) -> None
+        Constructs UDP packets from a frame and sends one packet per
+        baseline per subscriber. Every packet is built once per packet
+        version and then sent to all subscribers over the provider's
+        single UDP socket, send errors are counted per subscriber (see
+        inst.get_subscriber_stats) instead of aborting the broadcast."""
+        self.logger.info('new correlation at %f' % frame.corr_time)
+        by_version = {}
+        for subscriber, version in self.subscribers.items():
+            by_version.setdefault(version, []).append(subscriber)
+        for version, subscribers in by_version.iteritems():
+            pkts = [SHORT.pack(len(pkt)+SHORT_SIZE) + pkt
+                    for pkt in self._packet_iter(frame, version)]
+            self.logger.debug('sending {0} packets, {1} bytes (version {2})'.format(
+                len(pkts), sum(len(pkt) for pkt in pkts), version))
+            for subscriber in subscribers:
+                self._send_all(subscriber, pkts)
+        if frame.stage_times is not None and timings.enabled:
+            self._record_stages(frame.stage_times + (time(),))
+
+    def _record_stages(self, stage_times):
+        """ Feeds the time spent in each stage of the last integration, up
+        to the end of its broadcast, to phringes.core.metrics.timings as
+        the 'stage_*' methods of the provider's class."""
+        name = self.__class__.__name__
+        for stage, start, stop in zip(('pickup', 'read', 'process', 'broadcast'),
+                                      stage_times[:-1], stage_times[1:]):
+            timings.record((name, 'stage_' + stage), max(0, stop - start))
+
+    def _send_all(self, subscriber, pkts):
+        """ Sends every packet to one subscriber and updates its counters,
+        this is the hot loop of the broadcast so it is not logged."""
+        sent = nbytes = errors = 0
+        last_error = None
+        sendto = self._udp_sock.sendto
+        for pkt in pkts:
+            try:
+                nbytes += sendto(pkt, subscriber)
+                sent += 1
+            except SocketError, err:
+                errors += 1
+                last_error = str(err)
+        stats = self.subscriber_stats.get(subscriber)
+        if stats is not None:
+            stats['packets'] += sent
+            stats['bytes'] += nbytes
+            stats['errors'] += errors
+            if last_error is not None:
+                stats['last_error'] = last_error
+        if errors:
+            self.logger.warning('%d of %d packets to %s:%d failed: %s'
+                                % ((errors, len(pkts)) + subscriber + (last_error,)))
 
     @info
     def start(self):
         """ inst.start() -> None
-        Starts inst._provider_loop() in a separate thread. Use inst.stop()
-        to kill that thread. Can be used repeatedly to restart the provider
-        loop."""
+        Starts inst._provider_loop() and inst._broadcast_loop() in
+        separate threads. Use inst.stop() to kill those threads. Can be
+        used repeatedly to restart the provider loop."""
+        if self._free_frames is None:
+            self._free_frames = Queue()
+            self._ready_frames = Queue()
+            for n in range(self._ring_size):
+                self._free_frames.put(self._new_frame())
+        while not self._ready_frames.empty(): # left unsent by inst.stop()
+            self._free_frames.put(self._ready_frames.get())
         self._stopevent.clear()
         self._loop_thread = Thread(target=self._provider_loop)
+        self._broadcast_thread = Thread(target=self._broadcast_loop)
         self._loop_thread.start()
+        self._broadcast_thread.start()
 
     @info
     def stop(self):
         """ inst.stop() -> None
-        Stops the provider loop by setting inst._stopevent."""
+        Stops the provider loop by setting inst._stopevent, frames that
+        were not sent yet are dropped."""
         self._stopevent.set()
         self._loop_thread.join()
+        self._broadcast_thread.join()
+
+
+class ProviderFrame:
+    """ One integration as captured by a BasicCorrelationProvider's
+    readout thread for its broadcast thread: the correlation time, the
+    stage times (or None) and the provider specific 'data'."""
+
+    def __init__(self, data=None):
+        self.corr_time = None
+        self.stage_times = None
+        self.data = {} if data is None else data
 
 
 class BasicRequestHandler(BaseRequestHandler):
@@ -185,6 +429,8 @@ class BasicRequestHandler(BaseRequestHandler):
     the given 'server' given that class's command set, and then sends
     the appropriate responses."""
 
+    idle_timeout = 300.0 # seconds a persistent connection may stay idle
+
     @debug
     def __init__(self, request, client_address, server):
         """ BasicRequestHandler(request, client_address, server) -> inst
@@ -192,56 +438,292 @@ class BasicRequestHandler(BaseRequestHandler):
         self.logger = logging.getLogger(self.__class__.__name__)
         BaseRequestHandler.__init__(self, request, client_address, server)
 
+    def _respond(self, response):
+        """ inst._respond(response) -> None
+        Sends a response framed like the request it answers, a response too
+        large for a short frame is replaced by error code -3."""
+        if self._extended:
+            header = extended_header(len(response))
+        elif len(response) + SHORT_SIZE > MAX_SHORT_FRAME:
+            self.logger.error('response of %d bytes needs extended framing!' % len(response))
+            header, response = SHORT.pack(3), SBYTE.pack(-3)
+        else:
+            header = SHORT.pack(len(response) + SHORT_SIZE)
+        self.request.sendall(header + response)
+
     @error
     def _null_response(self, msg):
         self.logger.error(msg)
-        self.request.sendall(SHORT.pack(2) + SBYTE.pack(-1))
+        self._respond(SBYTE.pack(-1))
         
     @error
     def _incorrect_size(self, name, good, bad):
         self.logger.error(
             "%s should be %s bytes but is %s instead" %(name, good, bad)
             )
-        self.request.sendall(SHORT.pack(2) + SBYTE.pack(-2))
+        self._respond(SBYTE.pack(-2))
 
     @error
     def _no_command(self, cmd):
         self.logger.error('no such command word %d!' % cmd)
-        self.request.sendall(SHORT.pack(2) + SBYTE.pack(-1))
+        self._respond(SBYTE.pack(-1))
+
+    def _recv_exact(self, size):
+        """ inst._recv_exact(size) -> bytearray
+        Reads exactly 'size' bytes from the connection into a preallocated
+        buffer, never more, so that pipelined requests following this one
+        stay in the socket. Returns whatever was read so far if the client
+        closes the connection."""
+        buf = bytearray(size)
+        view = memoryview(buf)
+        received = 0
+        while received < size:
+            count = self.request.recv_into(view[received:], size - received)
+            if not count:
+                return buf[:received]
+            received += count
+        return buf
 
     @debug
     def handle(self):
         """ inst.handle() -> None
-        Handles a specific request by finding the appropropriate member
-        function of the instantiating BasicTCPServer using that instance's
-        _command_set member with the first byte of the request as the command 
-        word, and the rest of the request is passed as the arguments. The 
-        return value of the method is then sent back over TCP."""
-        buf = ""
-        size = None
-        while buf < size or size is None:
-            request = self.request.recv(MAX_REQUEST_SIZE)
-            if not request:
-                return self._null_response('null packet received!')
-            elif len(request)>=2 and size is None:
-                size = SHORT.unpack(request[:2])[0]
-            buf += request
-        if len(buf) != size:
-            return self._incorrect_size('request', size, len(buf))
-
-        # buf should now have the full message
-        self.logger.debug('request of size %d (%s)'%(len(request), repr(buf)))
-        args = buf[3:]
-        cmd = BYTE.unpack(buf[2])[0]
-        method = self.server._command_set.get(cmd)
-        if method:
-            with RLock():
-                response = self.server._command_set[cmd](args)
+        Handles requests by finding the appropropriate member function of
+        the instantiating BasicTCPServer using that instance's _command_set
+        member with the first byte of the request as the command word, and
+        the rest of the request is passed as the arguments. The return value
+        of the method is then sent back over TCP.
+
+        The connection is kept open and requests are answered in order until
+        the client closes it (or stays idle for inst.idle_timeout seconds),
+        so clients may pipeline several requests over one connection. One-shot
+        clients that close after their first response are served as before.
+
+        Requests come in either framing (see BasicTCPServer) and each one is
+        answered in the framing it used."""
+        self.request.settimeout(self.idle_timeout)
+        served = 0
+        while True:
+            self._extended = False
+            try:
+                header = self._recv_exact(SHORT_SIZE)
+                if not header:
+                    if not served:
+                        self._null_response('null packet received!')
+                    return
+                elif len(header) < SHORT_SIZE:
+                    return self._incorrect_size('request', SHORT_SIZE, len(header))
+                size = SHORT.unpack(header)[0]
+                header_size = SHORT_SIZE
+                if size == 0:
+                    self._extended = True
+                    header = self._recv_exact(LONG_SIZE)
+                    if len(header) < LONG_SIZE:
+                        return self._incorrect_size('request', LONG_SIZE, len(header))
+                    size = LONG.unpack(header)[0]
+                    header_size = EXTENDED_HEADER_SIZE
+                    if size > MAX_EXTENDED_REQUEST:
+                        return self._incorrect_size('request', 'at most %d' % MAX_EXTENDED_REQUEST, size)
+                if size <= header_size:
+                    return self._incorrect_size('request', header_size+1, size)
+                buf = self._recv_exact(size - header_size)
+            except SocketTimeout:
+                self.logger.debug('connection idle, closing after %d requests' % served)
+                return
+            if len(buf) != size - header_size:
+                return self._incorrect_size('request', size, len(buf) + header_size)
+
+            # buf should now have the full message
+            self.logger.debug('request of size %d (command %d)' % (size, buf[0]))
+            cmd = buf[0]
+            args = str(buf[1:])
+            if cmd in self.server._command_set:
+                response = self.server._dispatch(cmd, args)
+            else:
+                self._no_command(cmd)
+                served += 1
+                continue
+            # finally if all went well send our response
+            self._respond(response)
+            served += 1
+
+
+class BasicAsyncChannel(asyncore.dispatcher):
+    """ The counterpart of BasicRequestHandler for a BasicTCPServer running
+    under inst.serve_async: it reads requests from one client connection
+    without blocking and answers them in order. The next request of a
+    pipelined connection is dispatched only once the previous one has been
+    answered."""
+
+    recv_size = 65536
+
+    def __init__(self, server, sock, client_address, map):
+        asyncore.dispatcher.__init__(self, sock, map=map)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.server = server
+        self.client_address = client_address
+        self._inbuf = bytearray()
+        self._outbuf = deque() # framed responses, the first partly sent
+        self._outpos = 0
+        self._extended = False
+        self._busy = False
+        self._closing = False
+        self._closed = False
+        self._served = 0
+
+    def readable(self):
+        # a full request fits in MAX_EXTENDED_REQUEST, pipelined ones beyond
+        # that wait in the socket until the earlier ones have been answered
+        return not self._closing and len(self._inbuf) < MAX_EXTENDED_REQUEST
+
+    def writable(self):
+        return bool(self._outbuf)
+
+    def handle_read(self):
+        data = self.recv(self.recv_size)
+        if data:
+            self._inbuf.extend(data)
+            self._next_request()
+
+    def handle_write(self):
+        self._outpos += self.send(buffer(self._outbuf[0], self._outpos))
+        if self._outpos == len(self._outbuf[0]):
+            self._outbuf.popleft()
+            self._outpos = 0
+        self._close_when_done()
+
+    def handle_close(self):
+        """ The client closed its end, answer what it has already sent."""
+        if not self._served and not self._busy and not self._inbuf:
+            self.logger.error('null packet received!')
+            self._reply(SBYTE.pack(-1))
+        self._closing = True
+        self._close_when_done()
+
+    def close(self):
+        self._closed = True
+        asyncore.dispatcher.close(self)
+
+    def _close_when_done(self):
+        if self._closing and not self._closed and not self._busy and not self._outbuf:
+            self.close()
+
+    def _reply(self, response):
+        if self._extended:
+            header = extended_header(len(response))
+        elif len(response) + SHORT_SIZE > MAX_SHORT_FRAME:
+            self.logger.error('response of %d bytes needs extended framing!' % len(response))
+            header, response = SHORT.pack(3), SBYTE.pack(-3)
         else:
-            return self._no_command(cmd)
-        # finally if all went well send our response
-        self.request.sendall(SHORT.pack(len(response)+2) + response)
-        #self.logger.debug('sent %s bytes' % sent)
+            header = SHORT.pack(len(response) + SHORT_SIZE)
+        self._outbuf.append(header + response)
+
+    def _next_request(self):
+        inbuf = self._inbuf
+        while not self._busy and not self._closing and len(inbuf) >= SHORT_SIZE:
+            size = SHORT.unpack_from(inbuf)[0]
+            header_size = SHORT_SIZE
+            self._extended = (size == 0)
+            if self._extended:
+                if len(inbuf) < EXTENDED_HEADER_SIZE:
+                    break
+                size = LONG.unpack_from(inbuf, SHORT_SIZE)[0]
+                header_size = EXTENDED_HEADER_SIZE
+            if size <= header_size:
+                self.logger.error('request should be at least %d bytes but is %d' % (header_size+1, size))
+                self._reply(SBYTE.pack(-2))
+                self._closing = True
+            elif size > MAX_EXTENDED_REQUEST:
+                self.logger.error('request should be at most %d bytes but is %d' % (MAX_EXTENDED_REQUEST, size))
+                self._reply(SBYTE.pack(-2))
+                self._closing = True
+            elif len(inbuf) >= size:
+                cmd = inbuf[header_size]
+                args = str(inbuf[header_size+1:size])
+                # consume the request first, the response may come right away
+                del inbuf[:size]
+                if cmd in self.server._command_set:
+                    self._busy = True
+                    self.server._async_dispatch(self, cmd, args)
+                else:
+                    self.logger.error('no such command word %d!' % cmd)
+                    self._reply(SBYTE.pack(-1))
+                    self._served += 1
+            else:
+                break
+        self._close_when_done()
+
+    def respond(self, response):
+        """ inst.respond(response) -> None
+        Called (in the event loop) with the result of the request that was
+        dispatched last, or None if the command raised an exception in which
+        case the connection is dropped just like BasicRequestHandler does."""
+        if self._closed:
+            return
+        self._busy = False
+        self._served += 1
+        if response is None:
+            self._closing = True
+        else:
+            self._reply(response)
+            self._next_request()
+        self._close_when_done()
+
+    def flush(self):
+        """ inst.flush() -> None
+        Blocks until any buffered responses have been sent."""
+        try:
+            self.socket.setblocking(1)
+            while self._outbuf:
+                self.socket.sendall(buffer(self._outbuf.popleft(), self._outpos))
+                self._outpos = 0
+        except SocketError:
+            self._outbuf.clear()
+
+
+class BasicAsyncAcceptor(asyncore.dispatcher):
+    """ Accepts connections on the (already listening) server socket and
+    creates a BasicAsyncChannel for each."""
+
+    def __init__(self, server, map):
+        asyncore.dispatcher.__init__(self, server.socket, map=map)
+        self.accepting = True
+        self.server = server
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, client_address = pair
+            BasicAsyncChannel(self.server, sock, client_address, self._map)
+
+    def close(self):
+        # the socket belongs to the server, which closes it itself
+        self.del_channel()
+
+
+class BasicAsyncWaker(asyncore.file_dispatcher):
+    """ The read end of a pipe in the event loop, writing to it from another
+    thread (see inst.wake) makes the loop handle the server's finished
+    requests right away."""
+
+    def __init__(self, server, map):
+        read_fd, self._write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, map=map)
+        os.close(read_fd) # file_dispatcher keeps a duplicate
+        self.server = server
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(MAX_REQUEST_SIZE)
+        self.server._async_completed()
+
+    def wake(self):
+        os.write(self._write_fd, 'w')
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._write_fd)
 
 
 class BasicTCPServer(ThreadingTCPServer):
@@ -253,6 +735,10 @@ class BasicTCPServer(ThreadingTCPServer):
     Note: see 'backend.simulator' for an example on how to subclass
     this class."""
 
+    # persistent connections keep their handler threads waiting in recv for
+    # up to idle_timeout, they must not keep the process alive after shutdown
+    daemon_threads = True
+
     @debug
     def __init__(self, address, handler=BasicRequestHandler,
                  correlator=BasicCorrelationProvider,
@@ -277,6 +763,19 @@ class BasicTCPServer(ThreadingTCPServer):
         [ size  ][command word]:[variable length] -> [ size  ][error code]:[return values ]
         [2-bytes][   1-byte   ]:[max 1016-bytes ] -> [2-bytes][  1-byte  ]:[max 1016-bytes]
 
+        The size counts the whole frame, so it limits a request or response
+        to 64 KB. Larger payloads use the extended framing, where a size of 0
+        is followed by the real size of the whole frame as 4 bytes:
+
+        [   0   ][ size  ][command word]:[variable length] -> [   0   ][ size  ][error code]:[...]
+        [2-bytes][4-bytes][   1-byte   ]:[   variable    ] -> [2-bytes][4-bytes][  1-byte  ]:[...]
+
+        Extended requests larger than MAX_EXTENDED_REQUEST bytes are answered
+        with the error code -2 and the connection is closed.
+
+        Every response uses the framing of its request; a response that does
+        not fit a short frame is replaced by the error code -3.
+
         Note that the actual correlator data packets are sent over UDP, not
         through this command set (see the doc-string for BasicCorrelation-
         Provider. Below is a list of available commands, the command word
@@ -284,12 +783,14 @@ class BasicTCPServer(ThreadingTCPServer):
         self.* and the required arguments (for more information on each
         request see the appropriate documentation for that method):
 
-        0    - self.subscribe(address=(ip, port))
+        0    - self.subscribe(address=(ip, port), [version])
         1    - self.unsubscribe(address=(ip, port))
+        4    - self.batch(requests=[[size][cmd][args], ...])
         8    - self.start_correlator()
         9    - self.stop_correlator()
         10   - self.get_integration_time()
         11   - self.set_integration_time(time)
+        31   - self.get_metrics(prefix)
         32   - self.get_phase_offsets(for_antennas=[1,2,3,...])
         33   - self.set_phase_offsets(ant_val=[1,0.0,2,0.0,3,0.0...])
         34   - self.get_delay_offsets(for_antennas=[1,2,3,...])
@@ -300,19 +801,37 @@ class BasicTCPServer(ThreadingTCPServer):
         Commands 8-31 are reserved for handling correlator specific parameters.
         Commands 32-127 are reserved for adjusting feedback parameters.
         Commands 128-254 are reserved for user specific methods
-        Command 255 is reserved for shutting down the server."""
+        Command 255 is reserved for shutting down the server.
+
+        Commands are run while holding the locks named for them in
+        _command_locks (by default just 'state'), the server has one lock
+        per resource: 'state' for its in-memory parameters and 'hardware'
+        for the links to the boards. Subclasses list the commands that need
+        other locks, and commands that stop threads which take these locks
+        themselves must hold none. See inst._dispatch.
+
+        The server either handles each connection in its own thread through
+        inst.serve_forever, or all of them in a single event loop through
+        inst.serve_async."""
         self.logger = logging.getLogger(self.__class__.__name__)
         self._command_set = { 0 : self.subscribe,
                               1 : self.unsubscribe,
+                              4 : self.batch,
                               8 : self.start_correlator,
                               9 : self.stop_correlator,
                               10 : self.get_integration_time,
                               11 : self.set_integration_time,
+                              31 : self.get_metrics,
                               32 : self.get_phase_offsets,
                               33 : self.set_phase_offsets,
                               34 : self.get_delay_offsets,
                               35 : self.set_delay_offsets,
                               255 : self.shutdown }
+        self._locks = {'state': RLock(), 'hardware': RLock()}
+        self._command_locks = { 4 : (), 8 : (), 9 : (), 31 : (), 255 : () }
+        self._serving_async = False
+        self._async_map = None
+        self._executor = None
         self._started = False
         self._antennas = antennas
         self._bandwidth = analog_bandwidth
@@ -332,6 +851,11 @@ class BasicTCPServer(ThreadingTCPServer):
         )
         ThreadingTCPServer.__init__(self, address, handler)
 
+    _lock_order = ('hardware', 'state')
+    _default_locks = ('state',)
+    _offload_locks = frozenset(['hardware'])
+    _offload_commands = frozenset([4]) # holds no locks but runs others
+
     @info
     def server_bind(self):
         """ Overloaded method to allow address reuse."""
@@ -343,9 +867,154 @@ class BasicTCPServer(ThreadingTCPServer):
         """ Overloaded method that kills the correlator before shutdown."""
         if self._started:
             self.stop_correlator('')
-        ThreadingTCPServer.shutdown(self)
+        if self._serving_async:
+            self._serving_async = False
+            self._waker.wake()
+        else:
+            ThreadingTCPServer.shutdown(self)
         return SBYTE.pack(0)
 
+    def _acquire(self, cmd, blocking=True):
+        """ inst._acquire(cmd, blocking=True) -> [lock, ...] or None
+        Acquires the locks 'cmd' needs, always in the order of _lock_order
+        so that two commands cannot deadlock. Returns None if blocking is
+        False and one of them is taken."""
+        names = self._command_locks.get(cmd, self._default_locks)
+        held = []
+        for name in self._lock_order:
+            if name in names:
+                lock = self._locks[name]
+                if not lock.acquire(blocking):
+                    self._release(held)
+                    return None
+                held.append(lock)
+        return held
+
+    def _release(self, held):
+        for lock in reversed(held):
+            lock.release()
+
+    def _dispatch(self, cmd, args):
+        """ inst._dispatch(cmd, args) -> response
+        Runs the method registered for command word 'cmd' while holding the
+        locks it needs (see inst._acquire)."""
+        held = self._acquire(cmd)
+        try:
+            return self._command_set[cmd](args)
+        finally:
+            self._release(held)
+
+    def _async_dispatch(self, channel, cmd, args):
+        """ inst._async_dispatch(channel, cmd, args) -> None
+        Called by the event loop for every request. Commands that need one
+        of the _offload_locks (the slow, blocking ones) are handed to the
+        worker threads, as are ones whose locks are busy; the rest run right
+        here. The response is passed to channel.respond."""
+        names = self._command_locks.get(cmd, self._default_locks)
+        held = None
+        if self._executor is None:
+            held = self._acquire(cmd)
+        elif not (cmd in self._offload_commands or
+                  self._offload_locks.intersection(names)):
+            held = self._acquire(cmd, blocking=False)
+        if held is None:
+            future = self._executor.submit(self._dispatch, cmd, args)
+            future.add_done_callback(lambda f: self._async_done(channel, f))
+            return
+        try:
+            response = self._command_set[cmd](args)
+        except:
+            self.logger.exception('command %d failed' % cmd)
+            response = None
+        finally:
+            self._release(held)
+        channel.respond(response)
+
+    def _async_done(self, channel, future):
+        # runs in a worker thread, hand the result over to the event loop
+        try:
+            response = future.get()
+        except:
+            response = None
+        self._completed.put((channel, response))
+        self._waker.wake()
+
+    def _async_completed(self):
+        while not self._completed.empty():
+            channel, response = self._completed.get()
+            channel.respond(response)
+
+    @info
+    def serve_async(self, workers=4, poll_interval=0.5):
+        """ inst.serve_async(workers=4, poll_interval=0.5) -> None
+        An alternative to inst.serve_forever which handles every connection
+        in one asyncore event loop instead of a thread per connection. Blocking
+        commands (those needing the 'hardware' lock) run on a fixed pool of
+        'workers' threads, with workers=0 everything runs in the loop itself.
+        Returns once the server is shut down."""
+        self._async_map = {}
+        self._completed = Queue()
+        if workers:
+            self._executor = BoundedExecutor(workers, name='%s.workers' % self.__class__.__name__)
+        self._waker = BasicAsyncWaker(self, self._async_map)
+        BasicAsyncAcceptor(self, self._async_map)
+        self._serving_async = True
+        try:
+            while self._serving_async:
+                asyncore.loop(poll_interval, map=self._async_map, count=1)
+        finally:
+            self._serving_async = False
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            self._async_completed()
+            for channel in self._async_map.values():
+                if isinstance(channel, BasicAsyncChannel):
+                    channel.flush()
+            asyncore.close_all(self._async_map)
+
+    @info
+    def batch(self, args):
+        """ inst.batch(requests=[[size][cmd][args], ...]) -> responses=[[size][err][values], ...]
+        Runs a sequence of requests in order and returns all of their responses
+        in one packet. Each request and each response is framed exactly as it
+        would be on its own connection:
+
+        size(0) : cmd(0)  : args(0)  : size(1) : cmd(1)  : args(1)  : ...
+        UShort  : UByte   : variable : UShort  : UByte   : variable : ...
+
+        and every request is dispatched as if it had been sent alone (taking
+        its own locks). A batch may not contain another batch (4) or a shutdown
+        (255). The return packet starts with an error code:
+        0  = all requests were run, each response carries its own error code
+             (-3 for a response too large for a short frame)
+        -1 = unknown or forbidden command word in the batch, nothing was run
+        -2 = the requests are not framed correctly, nothing was run"""
+        requests = []
+        offset = 0
+        while offset < len(args):
+            if len(args) - offset <= SHORT_SIZE:
+                self.logger.error('truncated request in batch')
+                return SBYTE.pack(-2)
+            size = SHORT.unpack(args[offset:offset+SHORT_SIZE])[0]
+            if size <= SHORT_SIZE or offset+size > len(args):
+                self.logger.error('request of size %d does not fit the batch' % size)
+                return SBYTE.pack(-2)
+            cmd = BYTE.unpack(args[offset+SHORT_SIZE])[0]
+            if cmd in (4, 255) or cmd not in self._command_set:
+                self.logger.error('command word %d cannot be batched!' % cmd)
+                return SBYTE.pack(-1)
+            requests.append((cmd, args[offset+SHORT_SIZE+1:offset+size]))
+            offset += size
+        responses = [SBYTE.pack(0)]
+        for cmd, cmd_args in requests:
+            response = self._dispatch(cmd, cmd_args)
+            if len(response) + SHORT_SIZE > MAX_SHORT_FRAME:
+                self.logger.error('response to %d is too large for a batch!' % cmd)
+                response = SBYTE.pack(-3)
+            responses.append(SHORT.pack(len(response)+2) + response)
+        return ''.join(responses)
+
     @debug
     def subscribe(self, args):
         """ inst.subscribe(address=(ip, port)) -> err_code
@@ -356,23 +1025,31 @@ class BasicTCPServer(ThreadingTCPServer):
         command word defined by self._command_set. Expects the following
         argument format:
 
-        address(0) : address(1) : address(2) : address(3) : port
-        UByte      : UByte      : UByte      : UByte      : UShort
+        address(0) : address(1) : address(2) : address(3) : port   : [version]
+        UByte      : UByte      : UByte      : UByte      : UShort : [UByte]
 
         where U implies unsigned, and address(n) is the appropriate number in the
         IP address string, e.g. address(0)=131 for the IP '131.142.8.153. This is a
         total argument length of 6 bytes, which with the command word is a total request
-        packet length of 7 bytes.
+        packet length of 7 bytes. The optional trailing byte requests a data packet
+        version (see BasicCorrelationProvider), without it the subscriber is sent
+        PICKLE_PACKET_VERSION packets.
 
         The request sender will receive a response with one of the following error codes:
-        0  = subscriber was successfully added
+        0  = subscriber was successfully added, if a version was requested this is
+             followed by an UByte holding the version that will actually be sent
         -1 = the given address is already in the list of subscribers
         -2 = an incorrect number of arguments was received"""
-        if len(args) == 6:
+        if len(args) in (6, 7):
             ip = '.'.join([str(i) for i in unpack('!4B', args[:4])])
             port = unpack('!H', args[4:6])[0]
             client_addr = (ip, port)
             if not self._correlator.is_subscriber(client_addr):
+                if len(args) == 7:
+                    requested = BYTE.unpack(args[6])[0]
+                    version = self._correlator.add_subscriber(client_addr, requested)
+                    self.logger.info('subscriber %s:%d added (version %d)'%(client_addr+(version,)))
+                    return pack('!bB', 0, version)
                 self._correlator.add_subscriber(client_addr)
                 self.logger.info('subscriber %s:%d added'%client_addr)
                 return BYTE.pack(0)
@@ -457,6 +1134,30 @@ class BasicTCPServer(ThreadingTCPServer):
         self._integration_time = unpack('!f', args)[0]
         return SBYTE.pack(0)
 
+    @debug
+    def get_metrics(self, args):
+        """ inst.get_metrics(prefix) -> err_code, metrics
+        Returns the call counts and latency statistics collected by
+        phringes.core.metrics.timings (see MethodTimings.snapshot) for the
+        methods, named 'class.method', that start with the optional prefix.
+        The return packet has an error code of 0 followed by one record per
+        method:
+
+        length : name     : calls : timed : mean : p50 : p90 : p99 : p99.9 : max
+        UByte  : variable : UInt  : UInt  : Float (the times in ms)       : ...
+
+        The statistics are only collected while timings are enabled, so the
+        packet may hold no records."""
+        prefix = args.rstrip('\x00')
+        records = [SBYTE.pack(0)]
+        for name, stats in sorted(timings.snapshot(prefix).iteritems()):
+            name = name[:255]
+            records.append(BYTE.pack(len(name)) + name + METRIC.pack(
+                stats['calls'], stats['timed'],
+                *[stats[field]*1000 for field in METRIC_FIELDS[2:]]
+                ))
+        return ''.join(records)
+
     @debug
     def get_value(self, param, index):
         return getattr(self, param)[index]
@@ -593,6 +1294,9 @@ class IncorrectSizeError(BasicNetworkError):
 class NotRespondingError(BasicNetworkError):
     pass
 
+class FrameTooLargeError(BasicNetworkError):
+    pass
+
 class ClientClosedError(BasicNetworkError):
     pass
 
@@ -627,6 +1331,7 @@ class BasicNetworkClient:
         self.address = (host, port)
         self.ack_trans = '', ''
         self.timeout = timeout
+        self._rbuf = bytearray()
 
     @debug
     def _open_socket(self):
@@ -657,51 +1362,129 @@ class BasicNetworkClient:
         """
         raise NotImplementedError
 
+    def _send_request(self, data):
+        try:
+            self._sock_send(data+self.ack_trans[0])
+        except SocketError:
+            self.logger.error("socket has been closed!")
+            raise SocketError, "socket has been closed!"
+
+    def _recv_more(self, buf):
+        """ _recv_more(buf) -> previous length of buf
+        Appends the next chunk received from the socket to the bytearray buf."""
+        try:
+            data = self._sock_recv(MAX_REQUEST_SIZE)
+        except SocketTimeout:
+            self.logger.warning("socket timed out on recv!")
+            raise NotRespondingError, "socket not responding!"
+        except SocketError:
+            self.logger.error("client has been closed!")
+            raise ClientClosedError, "client has been closed!"
+        if not data:
+            raise NullPacketError, "socket sending Null strings!"
+        before = len(buf)
+        buf.extend(data)
+        return before
+
     @debug
-    def _request(self, data, resp_size):
-        """ _request(data, resp_size) -> resposne
+    def _request(self, data, resp_size, responses=1):
+        """ _request(data, resp_size, responses=1) -> resposne
         
         This function should take the following arguments:
             
             @data      -- data to be sent over the socket
             @resp_size -- size of the response packet (see below)
+            @responses -- number of responses 'data' asks for
             #response  -- the response packet from the server
         
         Note, this function requires that the calling function know exactly
         what the size (in bytes) of the return packet will be, if they don't 
         match the socket will timeout.
+
+        The response is collected in a reusable bytearray and only the newly
+        received bytes (and the few before them that could start the end of
+        response marker) are searched for the marker. When 'data' holds
+        several commands, all their responses are read and the last one is
+        returned.
         
         """
-        end_request = self.ack_trans[0]
         end_response = self.ack_trans[1]
+        self._send_request(data)
+        buf = self._rbuf
+        del buf[:]
+        start = 0
+        while True:
+            before = self._recv_more(buf)
+            search = max(start, before - len(end_response) + 1)
+            while True:
+                stop = buf.find(end_response, search)
+                if stop < 0:
+                    break
+                responses -= 1
+                if responses <= 0:
+                    self.logger.debug("response of %d bytes" % (stop - start))
+                    return str(buf[start:stop])
+                start = search = stop + len(end_response)
+
+    def _request_iter(self, data):
+        """ _request_iter(data) -> generator of lines
+
+        The streaming counterpart of _request: yields each line of the
+        response (without its newline) as soon as it has arrived and cannot
+        be part of the end of response marker, so only a partial line and a
+        marker's length of bytes are ever buffered. Nothing is sent until the
+        first line is asked for. If the caller stops early, closing the
+        generator reads and discards the rest of the response so that the
+        next request starts in sync."""
+        end_response = self.ack_trans[1]
+        self._send_request(data)
+        buf = self._rbuf
+        del buf[:]
+        done = False
         try:
-            self._sock_send(data+end_request)
-        except SocketError:
-            self.logger.error("socket has been closed!")
-            raise SocketError, "socket has been closed!"           
-        buf = ""
-        while True:#len(buf) < resp_size:
-            try:
-                data = self._sock_recv(MAX_REQUEST_SIZE)
-                if not data:
-                    raise NullPacketError, "socket sending Null strings!"
-                buf += data
-                self.logger.debug("buffer: %r" % buf)
-                if buf.endswith(end_response):
-                    return buf[:-len(end_response)]
-            except SocketTimeout:
-                self.logger.warning("socket timed out on recv!")
-                raise NotRespondingError, "socket not responding!"
-            except SocketError:
-                self.logger.error("client has been closed!")
-                raise ClientClosedError, "client has been closed!"           
-        #return buf
+            while not done:
+                before = self._recv_more(buf)
+                stop = buf.find(end_response, max(0, before - len(end_response) + 1))
+                done = stop >= 0
+                # a newline past limit could belong to the marker
+                limit = stop if done else len(buf) - len(end_response) + 1
+                pos = 0
+                newline = buf.find('\n', pos, limit)
+                while newline >= 0:
+                    yield str(buf[pos:newline])
+                    pos = newline + 1
+                    newline = buf.find('\n', pos, limit)
+                if done and pos < stop:
+                    yield str(buf[pos:stop])
+                del buf[:pos]
+        except GeneratorExit:
+            while not done:
+                del buf[:max(0, len(buf) - len(end_response) + 1)]
+                before = self._recv_more(buf)
+                done = buf.find(end_response, max(0, before - len(end_response) + 1)) >= 0
+            raise
 
 
 class BasicInterfaceClient(BasicNetworkClient):
     """ An interface to the above BasicTCPServer, and its subclasses.
+
+    By default every request opens its own connection, pass persistent=True
+    to keep one connection open across requests (it is reopened once if the
+    server has dropped it) and use inst.pipeline to send several requests
+    before reading their responses. Call inst.close() when done.
+
+    Requests too large for a short frame are always sent with the extended
+    framing (see BasicTCPServer), pass extended=True to send every request
+    that way so that responses of any size can come back too.
     """
 
+    @debug
+    def __init__(self, host, port, timeout=3.0, persistent=False, extended=False):
+        BasicNetworkClient.__init__(self, host, port, timeout=timeout)
+        self.persistent = persistent
+        self.extended = extended
+        self.sock = None
+
     def _open_socket(self):
         self.sock = socket(AF_INET, SOCK_STREAM)
         self.sock.settimeout(self.timeout)
@@ -713,42 +1496,130 @@ class BasicInterfaceClient(BasicNetworkClient):
             self.sock.close()
         except SocketError:
             self.logger.warning("attempted to shutdown a closed socket!")
+        self.sock = None
 
     def _sock_recv(self, size):
         return self.sock.recv(size)
         
     def _sock_send(self, data):
         return self.sock.sendall(data)
-    
-    def _request(self, cmd, size=None):
-        buf = ""
-        self._open_socket()
-        self._sock_send(SHORT.pack(len(cmd)+2) + cmd)
-        while len(buf) < size or size is None:
-            request = self._sock_recv(MAX_REQUEST_SIZE)
-            if not request:
-                raise NullPacketError
-            if len(request)>=2 and size is None:
-                size = SHORT.unpack(request[:2])[0]
-            buf += request
-        if len(buf) != size:
-            self.logger.debug(buf)
-            self.logger.debug("response of size %d, should be %d" % (len(buf), size))
+
+    def _recv_exact(self, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        received = 0
+        while received < size:
+            count = self.sock.recv_into(view[received:], size - received)
+            if not count:
+                raise NullPacketError, "socket closed by the server!"
+            received += count
+        return buf
+
+    def _frame(self, cmd):
+        if self.extended or len(cmd) + SHORT_SIZE > MAX_SHORT_FRAME:
+            return extended_header(len(cmd)) + cmd
+        return SHORT.pack(len(cmd) + SHORT_SIZE) + cmd
+
+    def _read_response(self):
+        size = SHORT.unpack(self._recv_exact(SHORT_SIZE))[0]
+        header_size = SHORT_SIZE
+        if size == 0:
+            size = LONG.unpack(self._recv_exact(LONG_SIZE))[0]
+            header_size = EXTENDED_HEADER_SIZE
+        if size <= header_size:
+            self.logger.debug("response of size %d, should be at least %d" % (size, header_size+1))
             raise IncorrectSizeError, 'return packet is the wrong size!'
-        self._close_socket()
-        size, err = unpack('!Hb', buf[:3])
-        return size, err, buf[3:]
-        
+        buf = self._recv_exact(size - header_size)
+        err = SBYTE.unpack_from(buf)[0]
+        if err==-3 and header_size==SHORT_SIZE:
+            self.logger.warning("response too large, switching to extended framing")
+            self.extended = True
+            raise FrameTooLargeError, "response does not fit a short frame, please retry!"
+        return size, err, memoryview(buf)[1:].tobytes()
+
+    def _exchange(self, cmds, responses):
+        self._sock_send(''.join(self._frame(cmd) for cmd in cmds))
+        too_large = None
+        while len(responses) < len(cmds):
+            try:
+                responses.append(self._read_response())
+            except FrameTooLargeError, too_large:
+                # read the rest so the connection stays in step
+                responses.append(None)
+        if too_large is not None:
+            raise too_large
+        return responses
+
+    def _pipeline(self, cmds):
+        if not self.persistent:
+            self._open_socket()
+            try:
+                return self._exchange(cmds, [])
+            finally:
+                self._close_socket()
+        for retry in (False, True):
+            responses = []
+            if self.sock is None:
+                self._open_socket()
+            try:
+                return self._exchange(cmds, responses)
+            except SocketTimeout:
+                self._close_socket()
+                raise
+            except (NullPacketError, SocketError):
+                # the server may have closed an idle connection, only
+                # resend if none of the requests were answered
+                self._close_socket()
+                if retry or responses:
+                    raise
+                self.logger.debug("connection dropped, reconnecting")
+
+    def _request(self, cmd, size=None):
+        return self._pipeline([cmd])[0]
+
+    @debug
+    def pipeline(self, cmds):
+        """ inst.pipeline(cmds=[cmd1, cmd2, ...]) -> [(size, err, resp), ...]
+        Sends all the given requests (command word followed by its arguments)
+        before reading any response and returns the responses in order. On a
+        persistent client they all share its connection, otherwise they share
+        a single new connection.
+
+        If any response was too large for a short frame FrameTooLargeError
+        is raised once all of them have been read. The server has run every
+        request by then, so only requests without side effects may simply
+        be sent again (the client now uses extended framing)."""
+        return self._pipeline(list(cmds))
+
+    @debug
+    def close(self):
+        """ inst.close() -> None
+        Closes the persistent connection, if one is open."""
+        if self.sock is not None:
+            self._close_socket()
+
     @debug
-    def subscribe(self, udp_host, udp_port):
+    def subscribe(self, udp_host, udp_port, version=None):
+        """ Subscribes the given UDP address to the correlator and returns
+        the data packet version it will be sent. If a version is given it
+        is requested from the server, servers that do not understand the
+        request fall back to PICKLE_PACKET_VERSION."""
         octects = [int(i) for i in udp_host.split('.')]
         ipv4_addr = octects + [udp_port]
         cmd = pack('!B4BH', 0, *ipv4_addr)
+        if version is not None:
+            size, err, resp = self._request(cmd + BYTE.pack(version))
+            if err==0:
+                return BYTE.unpack(resp[:1])[0]
+            elif err==-1:
+                raise Exception, "address already a subscriber!"
+            self.logger.warning("server does not negotiate packet versions")
         size, err, resp = self._request(cmd)
         if err==-1:
             raise Exception, "address already a subscriber!"
         elif err==-2:
             raise Exception, "incorrect number of arguments"
+        return PICKLE_PACKET_VERSION
 
     @debug
     def unsubscribe(self, udp_host, udp_port):
@@ -791,29 +1662,117 @@ class BasicInterfaceClient(BasicNetworkClient):
             raise Exception, "error setting integration time!"
 
     @debug
-    def _get_values(self, command, val_type, val_size, *antennas):
-        cmd = pack('!B%dB' % len(antennas), command, *antennas)
-        size, err, resp = self._request(cmd)
+    def get_metrics(self, prefix=''):
+        """ inst.get_metrics(prefix='') -> {'class.method': stats, ...}
+        Gets the call counts and latency statistics the server collected for
+        the methods starting with 'prefix', each stats dictionary has the
+        'calls' and 'timed' counts and the 'mean', 'p50', 'p90', 'p99',
+        'p99.9' and 'max' latencies in seconds."""
+        cmd = BYTE.pack(31) + prefix
+        try:
+            size, err, resp = self._request(cmd)
+        except FrameTooLargeError: # now switched to extended framing,
+            size, err, resp = self._request(cmd) # safe to repeat a read
         if err:
-            errors = unpack('!%dB' % len(resp), resp)
-            raise Exception, "following antennas not in system: %r" % (errors,)
-        else:
-            return unpack('!%d%s' % (len(resp)/val_size, val_type), resp)
+            raise Exception, "error getting metrics!"
+        metrics = {}
+        offset = 0
+        while offset < len(resp):
+            length = BYTE.unpack(resp[offset])[0]
+            name = resp[offset+1:offset+1+length]
+            offset += 1 + length
+            values = METRIC.unpack(resp[offset:offset+METRIC.size])
+            offset += METRIC.size
+            stats = dict(zip(METRIC_FIELDS[:2], values[:2]))
+            stats.update((field, value/1000.) for field, value in zip(METRIC_FIELDS[2:], values[2:]))
+            metrics[name] = stats
+        return metrics
 
     @debug
-    def _set_values(self, command, ant_value_dict, val_type, val_size):
+    def batch(self, cmds):
+        """ inst.batch(cmds=[cmd1, cmd2, ...]) -> [(size, err, resp), ...]
+        Has the server run all the given requests (command word followed by
+        its arguments) in one exchange and returns their responses in order,
+        see BasicTCPServer.batch. A batch whose responses need extended
+        framing raises FrameTooLargeError after the server has run it, so
+        batches that set values should come from a client created with
+        extended=True rather than be retried."""
+        args = ''.join(SHORT.pack(len(cmd)+2) + cmd for cmd in cmds)
+        size, err, resp = self._request(BYTE.pack(4) + args)
+        if err==-1:
+            raise Exception, "batch has a command the server cannot batch!"
+        elif err==-2:
+            raise Exception, "batch requests are not framed correctly!"
+        responses = []
+        offset = 0
+        while offset < len(resp):
+            size = SHORT.unpack(resp[offset:offset+SHORT_SIZE])[0]
+            err = SBYTE.unpack(resp[offset+SHORT_SIZE])[0]
+            responses.append((size, err, resp[offset+SHORT_SIZE+1:offset+size]))
+            offset += size
+        return responses
+
+    def _get_values_cmd(self, command, *antennas):
+        return pack('!B%dB' % len(antennas), command, *antennas)
+
+    def _set_values_cmd(self, command, ant_value_dict, val_type):
         ant_val = []
         for k, v in ant_value_dict.iteritems():
             ant_val.extend([k, v])
-        cmd = pack('!B' + ('B%s'%val_type)*(len(ant_val)/2), command, *ant_val)
-        size, err, resp = self._request(cmd)
+        return pack('!B' + ('B%s'%val_type)*(len(ant_val)/2), command, *ant_val)
+
+    def _parse_values(self, response, val_type, val_size):
+        size, err, resp = response
         if err==-1:
             errors = unpack('!%dB' % len(resp), resp)
             raise Exception, "following antennas not in system: %r" % (errors,)
         elif err==-2:
             raise Exception, "unmatched antenna/value pairs!"
-        else:
-            return unpack('!%d%s' % (len(resp)/val_size, val_type), resp)
+        elif err:
+            raise Exception, "error %d getting values!" % err
+        return unpack('!%d%s' % (len(resp)/val_size, val_type), resp)
+
+    @debug
+    def _get_values(self, command, val_type, val_size, *antennas):
+        response = self._request(self._get_values_cmd(command, *antennas))
+        return self._parse_values(response, val_type, val_size)
+
+    @debug
+    def _set_values(self, command, ant_value_dict, val_type, val_size):
+        response = self._request(self._set_values_cmd(command, ant_value_dict, val_type))
+        return self._parse_values(response, val_type, val_size)
+
+    # name : (get command, set command, type, size)
+    _parameters = { 'phase_offsets' : (32, 33, 'f', FLOAT_SIZE),
+                    'delay_offsets' : (34, 35, 'f', FLOAT_SIZE) }
+
+    @debug
+    def get_parameters(self, names, *antennas):
+        """ inst.get_parameters(names=['phase_offsets', ...], *antennas) -> {name: values, ...}
+        Gets several of the per-antenna parameters in inst._parameters in
+        a single batch exchange."""
+        cmds = [self._get_values_cmd(self._parameters[name][0], *antennas) for name in names]
+        values = {}
+        for name, response in zip(names, self.batch(cmds)):
+            get_cmd, set_cmd, val_type, val_size = self._parameters[name]
+            values[name] = self._parse_values(response, val_type, val_size)
+        return values
+
+    @debug
+    def set_parameters(self, params):
+        """ inst.set_parameters(params={'delay_offsets': {1: 0.0, ...}, ...}) -> {name: values, ...}
+        Sets several of the per-antenna parameters in inst._parameters in a
+        single batch exchange and returns the values written for each."""
+        names = list(params)
+        cmds = []
+        for name in names:
+            get_cmd, set_cmd, val_type, val_size = self._parameters[name]
+            cmds.append(self._set_values_cmd(set_cmd, params[name], val_type))
+        values = {}
+        for name, response in zip(names, self.batch(cmds)):
+            get_cmd, set_cmd, val_type, val_size = self._parameters[name]
+            values[name] = self._parse_values(response, val_type, val_size)
+        return values
 
     @debug
     def get_phase_offsets(self, *antennas):
@@ -892,6 +1851,26 @@ class BasicTCPClient(BasicNetworkClient):
             else:
                 self.logger.error("exheeded retry count!")
 
+    def _command_iter(self, cmd, args, argsdict, argfmt):
+        """ _command_iter is the streaming counterpart of _command, it yields
+        the lines of the response as they arrive (see _request_iter). A
+        partly read response cannot be retried, so on errors the connection
+        is reopened and the error raised."""
+        args_str = argfmt.format(*args, **argsdict)
+        lines = self._request_iter(self.cmdfmt.format(cmd=cmd, args=args_str))
+        try:
+            for line in lines:
+                yield line
+        except (BasicNetworkError, SocketError):
+            self.logger.error("errors occured, reconnecting...")
+            try:
+                self.reconnect()
+            except SocketTimeout:
+                pass
+            raise
+        finally:
+            lines.close()
+
     @debug
     def _async_command(self, cmd, args, argsdict, argfmt, retparser, retsize):
         """ _async_command returns immediately and eventually stores the output
@@ -909,16 +1888,33 @@ class NoCorrelations(Exception):
 
 class BasicUDPClient(BasicNetworkClient):
     """ This is not _really_ a UDP client but functions as a client
-    to the BasicCorrelationProvider class. """
+    to the BasicCorrelationProvider class.
+
+    If a multicast_group is given the client joins that group (on the
+    interface given by 'host') and listens on 'port' for packets the
+    provider publishes there (see BasicCorrelationProvider.set_multicast)
+    instead of waiting for unicast packets on (host, port)."""
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, multicast_group=None):
         BasicNetworkClient.__init__(self, host, port)
+        self.multicast_group = multicast_group
         self._open_socket()
 
     def _open_socket(self):
         self.sock = socket(AF_INET, SOCK_DGRAM)
         self.sock.setblocking(False)
-        self.sock.bind(self.address)
+        if self.multicast_group is None:
+            self.sock.bind(self.address)
+            return
+        host, port = self.address
+        if host in ('', '0.0.0.0'):
+            interface = pack('!I', INADDR_ANY)
+        else:
+            interface = inet_aton(host)
+        self.sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.sock.bind((self.multicast_group, port))
+        self.sock.setsockopt(IPPROTO_IP, IP_ADD_MEMBERSHIP,
+                             inet_aton(self.multicast_group) + interface)
 
     def _sock_recv(self, size):
         data, addr = self.sock.recvfrom(size)
@@ -952,7 +1948,25 @@ class BasicUDPClient(BasicNetworkClient):
             self.logger.debug("response of size %d, should be %d" % (len(buf), size))
             raise IncorrectSizeError, 'return packet is the wrong size!'
         return buf[SHORT_SIZE:]
-            
+
+    @debug
+    def wait(self, timeout=None):
+        """ inst.wait(timeout=None) -> bool
+        Blocks until at least one datagram is ready to be read, returns
+        False if none arrived within 'timeout' seconds."""
+        readable, writable, errored = select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    def drain(self):
+        """ inst.drain() -> iterator
+        Yields every packet already queued on the socket without ever
+        blocking, i.e. everything that arrived since the last wakeup."""
+        while True:
+            try:
+                yield self._request('')
+            except NoCorrelations:
+                return
+
     @debug
     def reset(self):
         self._close_socket()
@@ -17,7 +17,9 @@ from struct import Struct, pack, unpack, calcsize
 try:
     from numpy.fft import ifft
     from numpy.random import normal
-    from numpy import array, arange, ones, mean, sin, cos, concatenate
+    from numpy import array, arange, ones, sin, cos, concatenate
+    from numpy import sqrt as nsqrt
+    from numpy import newaxis
 except ImportError:
     logging.error("""Numpy package required but not installed!
     Please install python-numpy >= 1.4.1""")
@@ -39,52 +41,70 @@ from basic import (
 
 
 class SimulatorCorrelationProvider(BasicCorrelationProvider):
-    
+
+    def _antenna_values(self, *params):
+        """ Returns, for each of the server's per-antenna dictionaries
+        named in 'params', an array of its values for the left and one for
+        the right antenna of every baseline (in inst._include_baselines
+        order)."""
+        antennas = self.server._antennas
+        rows = dict((a, i) for i, a in enumerate(antennas))
+        left = array([rows[b[0]] for b in self._include_baselines])
+        right = array([rows[b[1]] for b in self._include_baselines])
+        values = []
+        for param in params:
+            per_antenna = getattr(self.server, param)
+            per_antenna = array([per_antenna[a] for a in antennas], dtype=float)
+            values.append((per_antenna[left], per_antenna[right]))
+        return values
+
     @debug
     def correlate(self):
         """ inst.correlate() -> None
         Uses parameters extracted from an instance of SimulatorTCPServer
         to mimic the output of the PHRINGES hardware-based correlator. It
-        stores its output in appropriate instance members."""
-        antenna_temp = self.server._antenna_efficiency * self.server._source_flux
-        for baseline in self._include_baselines:
-            # For an unresolved source all baselines see the same
-            # correlated flux, use the radiometer equation with T_sys
-            # being the geometric mean of the antennas
-            system_temp = sqrt(self.server._system_temp[baseline[0]] *\
-                               self.server._system_temp[baseline[1]])
-            phase_rms = (system_temp/antenna_temp) /\
-                        sqrt(2 * (2*self.server._bandwidth/self._lags) *\
-                             self.server._integration_time)
-            delay = self.server._delays[baseline[1]] +\
-                    self.server._delay_offsets[baseline[1]] -\
-                    self.server._delays[baseline[0]] -\
-                    self.server._delay_offsets[baseline[0]] +\
-                    self.server._geometry.delay(baseline) +\
-                    self.server._atmosphere.delay(baseline)
-            phase = self.server._phases[baseline[1]] +\
-                    self.server._phase_offsets[baseline[1]] -\
-                    self.server._phases[baseline[0]] -\
-                    self.server._phase_offsets[baseline[0]] +\
-                    delay * pi * arange(0, 1+2.0/self._lags, 2.0/self._lags) +\
-                    normal(0, phase_rms, 1+self._lags/2) +\
-                    self.server._geometry.phase(baseline) +\
-                    self.server._atmosphere.phase(baseline)
-            amplitude = antenna_temp/system_temp *\
-                        ones(1+self._lags/2)
-            real = amplitude * cos(phase)
-            imag = amplitude * sin(phase)
-            half_spectrum_positive = real + imag*1j
-            half_spectrum_negative = real - imag*1j
-            full_spectrum = concatenate((half_spectrum_positive[:-1],
-                                         half_spectrum_negative[1+self._lags/2:0:-1]))
-            cross_correlation = ifft(full_spectrum).real
-            cross_correlation = concatenate((cross_correlation[self._lags/2:],
-                                             cross_correlation[0:self._lags/2]))
-            self.logger.debug('baseline %d-%d:' %baseline)
-            self.logger.debug('  phase noise RMS: %.2f rads' %phase_rms)
-            self.logger.debug('  amplitude across band: %.2f Wh' %(mean(amplitude)*10**4))
-            self._correlations[baseline] = cross_correlation * 2**32
+        stores its output in appropriate instance members.
+
+        Every baseline is simulated at once, as one row of arrays of shape
+        (n_baselines, ...), ending with a single batched inverse FFT."""
+        with self.server._locks['state']:
+            itime = self.server._integration_time
+            antenna_temp = self.server._antenna_efficiency * self.server._source_flux
+            ((sys_left, sys_right), (del_left, del_right), (doff_left, doff_right),
+             (ph_left, ph_right), (poff_left, poff_right)) = self._antenna_values(
+                '_system_temp', '_delays', '_delay_offsets', '_phases', '_phase_offsets'
+                )
+        self._stopevent.wait(itime)
+        self._last_correlation = time()
+        half = self._lags/2
+        # For an unresolved source all baselines see the same
+        # correlated flux, use the radiometer equation with T_sys
+        # being the geometric mean of the antennas
+        system_temp = nsqrt(sys_left * sys_right)
+        phase_rms = (system_temp/antenna_temp) /\
+                    sqrt(2 * (2*self.server._bandwidth/self._lags) * itime)
+        delay = del_right + doff_right - del_left - doff_left +\
+                self.server._geometry.delays() +\
+                self.server._atmosphere.delays()
+        phase = (ph_right + poff_right - ph_left - poff_left +\
+                 self.server._geometry.phases() +\
+                 self.server._atmosphere.phases())[:, newaxis] +\
+                delay[:, newaxis] * pi * arange(0, 1+2.0/self._lags, 2.0/self._lags) +\
+                normal(0, 1, (len(system_temp), 1+half)) * phase_rms[:, newaxis]
+        amplitude = (antenna_temp/system_temp)[:, newaxis] * ones(1+half)
+        real = amplitude * cos(phase)
+        imag = amplitude * sin(phase)
+        half_spectrum_positive = real + imag*1j
+        half_spectrum_negative = real - imag*1j
+        full_spectrum = concatenate((half_spectrum_positive[:, :-1],
+                                     half_spectrum_negative[:, 1+half:0:-1]), axis=1)
+        cross_correlation = ifft(full_spectrum, axis=1).real
+        cross_correlation = concatenate((cross_correlation[:, half:],
+                                         cross_correlation[:, 0:half]), axis=1)
+        self.logger.debug('phase noise RMS: %s rads' % phase_rms)
+        self._correlation_block = cross_correlation * 2**32
+        for row, baseline in enumerate(self._include_baselines):
+            self._correlations[baseline] = self._correlation_block[row]
 
 
 class SimulatorTCPServer(BasicTCPServer):
@@ -112,7 +132,7 @@ class SimulatorTCPServer(BasicTCPServer):
         135  - self.set_delays(ant_val=[1,0.0,2,0.0,3,0.0...])"""
         BasicTCPServer.__init__(self, address, handler=handler, 
                                 correlator=correlator, correlator_lags=correlator_lags, 
-                                n_antennas=n_antennas, initial_int_time=initial_int_time,
+                                antennas=range(n_antennas), initial_int_time=initial_int_time,
                                 antenna_diameter=antenna_diameter, analog_bandwidth=analog_bandwidth, 
                                 include_baselines=include_baselines)
         self._command_set.update({ 128 : self.get_source_flux,
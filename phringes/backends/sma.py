@@ -22,25 +22,34 @@ from socket import gethostname
 from collections import deque
 from math import pi, cos, sin
 from struct import Struct, pack, unpack
+from struct import error as StructError
 from datetime import datetime, timedelta
 from time import time, asctime, gmtime, sleep
-from threading import Thread, RLock, Event
+from threading import Thread, Event
 from Queue import Queue
 
 from numpy.random import randint
 from numpy.fft import fft, fftshift
 from numpy import array as narray
+from numpy import cos as ncos
+from numpy import sin as nsin
 from numpy import (
     array, zeros, arange, angle, 
     concatenate, ceil, loads, sign,
-    unwrap,
+    unwrap, newaxis, dtype,
+    empty, frombuffer, complex64,
+    float32, bitwise_or, asarray,
+    floor,
     )
 
 from phringes.backends import _dds
 from phringes.backends import dDS_clnt # old Python-only client
-from phringes.core.utils import get_phase_fit
+from phringes.core.utils import get_phase_fits
 from phringes.core.bee2 import BEE2Client
 from phringes.core.ibob import IBOBClient
+from phringes.core.executor import BoardExecutor, BoardErrors
+from phringes.core.shadow import RegisterShadow
+from phringes.core.metrics import Histogram, timings
 from phringes.core.loggers import (
     debug, info, warning, 
     critical, error,
@@ -49,7 +58,8 @@ from basic import (
     BasicCorrelationProvider, BasicRequestHandler,
     BasicTCPServer, BasicInterfaceClient, BasicUDPClient,
     BYTE, SBYTE, FLOAT, BYTE_SIZE, FLOAT_SIZE,
-    NoCorrelations,
+    PICKLE_PACKET_VERSION, BINARY_PACKET_VERSION,
+    STAGE_TIMES_FLAG, NoCorrelations, ProviderFrame,
 )
 
 
@@ -147,23 +157,60 @@ class DDSClient:
             lst = lst+24
         return lst
 
+    @debug
+    def get_local_sidereal_times(self, at_times, longitude):
+        """ inst.get_local_sidereal_times(at_times=[t0, t1, ...], longitude) -> array
+        Vectorized get_local_sidereal_time, the Julian date of each day is
+        found straight from the UNIX time and, unlike gmtime, fractions of
+        a second are kept."""
+        at_times = asarray(at_times, dtype=float)
+        days = floor(at_times/86400.)
+        ut_hours = (at_times - days*86400.)/3600.
+        jd = days + 2440587.5 # at 0h UT
+        t = (jd - 2451545.0)/36525.0
+        t0 = (6.697374558 + 2400.051336*t + 0.000025862*t**2) % 24.
+        gmst = (1.002737909*ut_hours + t0) % 24.
+        return (gmst + (longitude*(180/pi))/15.) % 24.
+
     @debug
     def get_hour_angle(self, source_rA, longitude, at_time):
         return self.get_local_sidereal_time(at_time, longitude)*(pi/12) - source_rA
 
+    @debug
+    def get_hour_angles(self, source_rA, longitude, at_times):
+        return self.get_local_sidereal_times(at_times, longitude)*(pi/12) - source_rA
+
     @debug
     def get_delay(self, H, a, b, c):
         return (10.0**9) * (a + b*cos(H) + c*sin(H))
 
     @debug
     def get_delays(self, at_time, offset=4000., given_phases=None):
-        delays = {}
-        query = self.query.copy()
-        H = self.get_hour_angle(query['rA'], query['refLong'], at_time)
-        for ant in range(len(query['antennaExists'])):
-            partial = self.get_delay(H, query['a'][ant], query['b'][ant], query['c'][ant])
-            delays[ant] = offset - partial
-        return delays
+        return dict(enumerate(self.get_delays_array([at_time], offset)[0]))
+
+    @debug
+    def get_delays_array(self, at_times, offset=4000., query=None):
+        """ inst.get_delays_array(at_times=[t0, t1, ...], offset=4000., query=None) -> delays
+        Computes the delays of every antenna at every time in one go,
+        delays[i, ant] is the delay (ns) of antenna 'ant' at at_times[i].
+        A query saved from inst.query can be passed in to evaluate an old
+        delay model without the DDS."""
+        if query is None:
+            query = self.query
+        n_ants = len(query['antennaExists'])
+        a, b, c = [asarray(query[k][:n_ants], dtype=float) for k in 'abc']
+        H = self.get_hour_angles(query['rA'], query['refLong'], at_times)[:, newaxis]
+        return offset - (10.0**9) * (a + b*ncos(H) + c*nsin(H))
+
+    @debug
+    def get_delay_model(self, at_times, fstop, offset=4000., query=None):
+        """ inst.get_delay_model(at_times, fstop, offset=4000., query=None) -> delays, phases
+        Same as get_delays_array but also returns the fringe stopping phases
+        (in degrees) for a fringe rate of 'fstop' GHz, both are arrays of
+        shape (len(at_times), n_antennas)."""
+        delays = self.get_delays_array(at_times, offset, query)
+        phases = sign(fstop)*(360*delays*abs(fstop) % 360)
+        return delays, phases
 
     @debug
     def formatTime(self, dec_time):
@@ -182,21 +229,49 @@ class BEE2CorrelationProvider(BasicCorrelationProvider):
     attached to a single BEE2 corner chip, reads off correlation
     functions for the requested set of baselines, and sends them
     over UDP packets to registered subscribers. See 'backends.basic.
-    BasicCorrelationProvider' for more detail."""
+    BasicCorrelationProvider' for more detail.
+
+    Besides the original pickled packets this provider can send
+    BINARY_PACKET_VERSION packets whose payload is the fixed layout
+    returned by inst.payload_type(lags): the lags and visibilities as
+    big-endian complex64, the phase fit as big-endian float32, followed
+    by the fitted delay and phase as big-endian float32."""
+
+    _packet_versions = (PICKLE_PACKET_VERSION, BINARY_PACKET_VERSION)
+    _payload_types = {}
 
     def __init__(self, server, include_baselines, 
                  bee2_host, bee2_port, lags=32,
-                 bof='bee2_calib_corr.bof'):
+                 bof='bee2_calib_corr.bof',
+                 poll_interval=0.005, poll_guard=0.05, ring_size=4):
         """ Overloaded method which adds some arguments necessary
-        for connecting to 'tcpborphserver' running on a BEE2."""
+        for connecting to 'tcpborphserver' running on a BEE2.
+
+        Instead of polling 'integ_cnt' at a fixed rate the provider
+        predicts when the next dump will happen (from 'integ_time' and
+        'syncsel') and sleeps until 'poll_guard' seconds before it, it
+        then polls every 'poll_interval' seconds until the dump is seen."""
         self.bram_format = 'rx{other}_{sideband}_{type}'
+        self._poll_interval = poll_interval
+        self._poll_guard = poll_guard
+        self._next_dump = None
+        self._last_dump = None
+        self._pickup_latencies = deque(maxlen=1024)
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.info('baselines: %r' % include_baselines)
-        BasicCorrelationProvider.__init__(self, server, include_baselines, lags)
-        self._complex_lags = dict((b, zeros(self._lags, dtype=complex)) for b in include_baselines)
-        self._visibilities = dict((b, zeros(self._lags-1, dtype=complex)) for b in include_baselines)
-        self._phase_fits = dict((b, zeros(self._lags-1)) for b in include_baselines)
-        self._phase_params = dict((b, (0., 0.)) for b in include_baselines)
+        BasicCorrelationProvider.__init__(self, server, include_baselines, lags, ring_size)
+        # every baseline owns one row of these blocks, the per-baseline
+        # dictionaries below are just views into them
+        self._baseline_rows = dict((b, i) for i, b in enumerate(include_baselines))
+        self._lag_block = zeros((len(include_baselines), self._lags), dtype=complex)
+        self._visibility_block = zeros((len(include_baselines), self._lags-1), dtype=complex)
+        self._phase_fit_block = zeros((len(include_baselines), self._lags-1))
+        self._phase_param_block = zeros((len(include_baselines), 2))
+        self._freqs = arange(-(self._lags/2-1), self._lags/2)
+        self._complex_lags = dict((b, self._lag_block[i]) for b, i in self._baseline_rows.iteritems())
+        self._visibilities = dict((b, self._visibility_block[i]) for b, i in self._baseline_rows.iteritems())
+        self._phase_fits = dict((b, self._phase_fit_block[i]) for b, i in self._baseline_rows.iteritems())
+        self._phase_params = dict((b, self._phase_param_block[i]) for b, i in self._baseline_rows.iteritems())
         self.delay_conv = (10**9) / ((self.server._bandwidth/self._lags) * 1.024 * 2 * pi) # ns*rad/lag
         self.bee2_host, self.bee2_port = bee2_host, bee2_port
         self.bee2 = BEE2Client(bee2_host, port=bee2_port)
@@ -205,12 +280,93 @@ class BEE2CorrelationProvider(BasicCorrelationProvider):
     def _process(self):
         self.fringe() # populates all the lags
 
-    def _data_iter(self):
+    @classmethod
+    def payload_type(cls, lags):
+        """ BEE2CorrelationProvider.payload_type(lags) -> dtype
+        The NumPy record type of a binary packet's payload."""
+        if lags not in cls._payload_types:
+            cls._payload_types[lags] = dtype([
+                ('lags', '>c8', (lags,)),
+                ('visibilities', '>c8', (lags-1,)),
+                ('phase_fits', '>f4', (lags-1,)),
+                ('delay', '>f4'),
+                ('phase', '>f4'),
+                ])
+        return cls._payload_types[lags]
+
+    @classmethod
+    def unpack_packet(cls, pkt, unpacker):
+        """ BEE2CorrelationProvider.unpack_packet(pkt, unpacker) -> correlation
+        Decodes a correlation packet of any version into the tuple
+        (corr_time, left, right, current, total, lags, visibility,
+        phase_fit, delay, phase). The arrays of binary packets are
+        read-only views over 'pkt', 'unpacker' is the Struct splitting
+        the payload of pickled packets."""
+        if BYTE.unpack(pkt[0])[0] == BINARY_PACKET_VERSION:
+            (version, flags, corr_time, left, right,
+             current, total, lags) = cls._binary_header_struct.unpack(
+                pkt[:cls._binary_header_size]
+                )
+            payload = frombuffer(pkt, dtype=cls.payload_type(lags), count=1,
+                                 offset=cls._binary_header_size)[0]
+            return (
+                corr_time, left, right, current, total, # header information
+                payload['lags'], payload['visibilities'], payload['phase_fits'],
+                float(payload['delay']), float(payload['phase']) # data
+                )
+        data = pkt[cls._header_size:] # should be 3 arrays and 2 floats
+        corr_time, left, right, current, total = cls._header_struct.unpack(pkt[:cls._header_size])
+        lagss, visibss, fitss, m, c = unpacker.unpack(data)
+        return (
+            corr_time, left, right, current, total, # header information
+            loads(lagss), loads(visibss), loads(fitss), m, c # data
+            )
+
+    @classmethod
+    def unpack_stage_times(cls, pkt):
+        """ BEE2CorrelationProvider.unpack_stage_times(pkt) -> (dumped, seen, read, processed, sent)
+        Decodes the stage times trailing a binary packet, returns None for
+        packets without them."""
+        if BYTE.unpack(pkt[0])[0] != BINARY_PACKET_VERSION or \
+               not BYTE.unpack(pkt[1])[0] & STAGE_TIMES_FLAG:
+            return None
+        return cls._stage_struct.unpack(pkt[-cls._stage_size:])
+
+    def _new_frame(self):
+        return ProviderFrame(dict(
+            (name, zeros(block.shape, dtype=block.dtype))
+            for name, block in self._blocks().iteritems()
+            ))
+
+    def _blocks(self):
+        return {'lags': self._lag_block,
+                'visibilities': self._visibility_block,
+                'phase_fits': self._phase_fit_block,
+                'phase_params': self._phase_param_block}
+
+    def _capture(self, frame):
+        for name, block in self._blocks().iteritems():
+            frame.data[name][...] = block
+
+    def _data_iter(self, frame, version=PICKLE_PACKET_VERSION):
+        blocks = frame.data
+        if version == BINARY_PACKET_VERSION:
+            payloads = empty(len(self._include_baselines), dtype=self.payload_type(self._lags))
+            payloads['lags'] = blocks['lags']
+            payloads['visibilities'] = blocks['visibilities']
+            payloads['phase_fits'] = blocks['phase_fits']
+            payloads['delay'] = blocks['phase_params'][:, 0] * self.delay_conv
+            payloads['phase'] = blocks['phase_params'][:, 1]
+            for baseline in self._include_baselines:
+                row = self._baseline_rows[baseline]
+                yield baseline, payloads[row:row+1].tostring()
+            return
         for baseline in self._include_baselines:
-            lags = self._complex_lags[baseline]
-            visibilities = self._visibilities[baseline]
-            phase_fits = self._phase_fits[baseline]
-            m, phase = self._phase_params[baseline]
+            row = self._baseline_rows[baseline]
+            lags = blocks['lags'][row]
+            visibilities = blocks['visibilities'][row]
+            phase_fits = blocks['phase_fits'][row]
+            m, phase = blocks['phase_params'][row]
             delay = m * self.delay_conv
             data = (
                 lags.dumps() +
@@ -225,15 +381,73 @@ class BEE2CorrelationProvider(BasicCorrelationProvider):
     def _read_lag(self, other, sideband):
         bram_real = self.bram_format.format(other=other, sideband=sideband, type='real')
         bram_imag = self.bram_format.format(other=other, sideband=sideband, type='imag')
-        real = self.bee2.bramread(bram_real, self._lags)
-        imag = self.bee2.bramread(bram_imag, self._lags)
-        return narray([real[i]+imag[i]*1j for i in range(self._lags)])
+        return self.bee2.bramread_complex(bram_real, bram_imag, self._lags)
+
+    @debug
+    def _read_lags(self, others, sideband):
+        """ Reads the lags of every given input in one pipelined
+        request to the BEE2, returns them as one row per input."""
+        pairs = [(self.bram_format.format(other=other, sideband=sideband, type='real'),
+                  self.bram_format.format(other=other, sideband=sideband, type='imag'))
+                 for other in others]
+        return self.bee2.bramread_complex_batch(pairs, self._lags)
+
+    @debug
+    def _wait_for_dump(self, integ_cnt, period):
+        """ Blocks until 'integ_cnt' on the BEE2 has moved past the given
+        count and returns the time the new dump was seen, or None if a
+        stop was requested in the meantime. The estimated delay between
+        the dump and its pickup is recorded in inst._pickup_latencies and,
+        while timings are enabled, as the 'pickup_latency' metric."""
+        predicted = self._next_dump
+        if predicted is not None:
+            self._stopevent.wait(predicted - self._poll_guard - time())
+        last_miss = time()
+        while self.bee2.regread('integ_cnt') <= integ_cnt:
+            last_miss = time()
+            self._stopevent.wait(self._poll_interval)
+            if self._stopevent.isSet():
+                return None # server requested a stop
+        seen = time()
+        # the dump happened somewhere between the last poll that missed
+        # it and now, trust the prediction if it falls in that window
+        if predicted is not None and last_miss < predicted <= seen:
+            dumped = predicted
+        else:
+            dumped = last_miss
+        self._next_dump = dumped + period
+        self._last_dump = dumped
+        self._pickup_latencies.append(seen - dumped)
+        if timings.enabled:
+            key = (self.__class__.__name__, 'pickup_latency')
+            timings.count(key)
+            timings.record(key, seen - dumped)
+        self.logger.debug('dump picked up %.2f ms late' % ((seen - dumped)*1000))
+        return seen
+
+    @debug
+    def get_pickup_latency(self):
+        """ inst.get_pickup_latency() -> (last, mean, max)
+        Statistics, in seconds, of the delay between a dump finishing on
+        the BEE2 and the provider noticing it (over the last 1024 dumps).
+        Clients get its distribution from the get_metrics command (31) as
+        'BEE2CorrelationProvider.pickup_latency'."""
+        latencies = list(self._pickup_latencies)
+        if not latencies:
+            return None
+        return latencies[-1], sum(latencies)/len(latencies), max(latencies)
 
     @debug
     def get_visibility(self, lags):
-        middle = ceil(len(lags)/2)
-        shifted = concatenate((lags[middle:], lags[1:middle]))
-        return fftshift(fft(shifted))
+        return self.get_visibilities(lags[newaxis])[0]
+
+    @debug
+    def get_visibilities(self, lags):
+        """ Batched get_visibility, transforms every row of 'lags'
+        (one per baseline) with a single axis-wise FFT."""
+        middle = int(ceil(lags.shape[-1]/2))
+        shifted = concatenate((lags[:, middle:], lags[:, 1:middle]), axis=-1)
+        return fftshift(fft(shifted, axis=-1), axes=-1)
 
     @info
     def fringe(self):
@@ -242,36 +456,103 @@ class BEE2CorrelationProvider(BasicCorrelationProvider):
         the BEE2 corner chip as well as setting integration times,
         etc. It then reads the correlations and stores them to be
         broadcast to its list of subscribers."""
-        with RLock(): # do all server stuff here
+        with self.server._locks['state']:
             mapping = self.server._mapping.copy()
         rev_mapping = dict((v, k) for k, v in mapping.iteritems())
-        refant = rev_mapping[self.bee2.regread('refant')]
-        integ_cnt = self.bee2.regread('integ_cnt')
-        while self.bee2.regread('integ_cnt') <= integ_cnt:
-            self._stopevent.wait(1.0) # 1 second for now
-            if self._stopevent.isSet():
-                return # server requested a stop
-        self._last_correlation = time()
-        for baseline in self._include_baselines:
-            # currently phringes only supports correlations
-            # to the reference antenna
-            if refant in baseline:
-                refindex = baseline.index(refant)
-                other = mapping[baseline[not refindex]]
-                self._complex_lags[baseline] = self._read_lag(other, 'usb')
-                #span = 100 * (abs(lags).max() - abs(lags).min()) / (2**31)
-                #self.logger.info('baseline %s: span=%.4f%%' % (repr(baseline), span))
-                self._visibilities[baseline] = self.get_visibility(self._complex_lags[baseline])
-                self._phase_params[baseline], self._phase_fits[baseline] = get_phase_fit(
-                    arange(-(self._lags/2-1), self._lags/2),
-                    angle(self._visibilities[baseline])
-                    )              
+        regs = self.bee2.bramread_batch(
+            ['refant', 'integ_cnt', 'integ_time', 'syncsel'], 1, signed=False
+            )
+        refant = rev_mapping[int(regs['refant'][0])]
+        period = int(regs['integ_time'][0]) * PERIOD_SYNCSEL[int(regs['syncsel'][0])]
+        seen = self._wait_for_dump(int(regs['integ_cnt'][0]), period)
+        if seen is None:
+            return # server requested a stop
+        self._last_correlation = seen
+        # currently phringes only supports correlations
+        # to the reference antenna
+        baselines = [b for b in self._include_baselines if refant in b]
+        if not baselines:
+            return
+        rows = [self._baseline_rows[b] for b in baselines]
+        others = [mapping[b[not b.index(refant)]] for b in baselines]
+        lags = self._read_lags(others, 'usb')
+        read = time()
+        #span = 100 * (abs(lags).max(axis=-1) - abs(lags).min(axis=-1)) / (2**31)
+        visibilities = self.get_visibilities(lags)
+        params, fits = get_phase_fits(self._freqs, angle(visibilities))
+        self._lag_block[rows] = lags
+        self._visibility_block[rows] = visibilities
+        self._phase_param_block[rows] = params
+        self._phase_fit_block[rows] = fits
+        self._stage_times = (self._last_dump, seen, read, time())
+
+
+class CorrelationFrame:
+    """ All the correlations of one integration, reassembled by
+    BEE2CorrelatorClient from the packets sharing the same corr_time.
+    The arrays are stacked with one row per baseline, row n holding the
+    packet whose 'current' field was n. Rows whose packet never arrived
+    stay zeroed and are flagged False in inst.received.
+
+    Iterating over a frame yields the received correlations as the same
+    tuples BEE2CorrelatorClient.get_correlation returns.
+
+    If the packets carried the provider's stage times inst.stage_times
+    holds them followed by the time the frame's last packet was received,
+    otherwise it is None."""
+
+    def __init__(self, corr_time, total, lags):
+        self.corr_time = corr_time
+        self.stage_times = None
+        self.total = total
+        self.baselines = [None] * total
+        self.lags = zeros((total, lags), dtype=complex64)
+        self.visibilities = zeros((total, lags-1), dtype=complex64)
+        self.phase_fits = zeros((total, lags-1), dtype=float32)
+        self.delays = zeros(total, dtype=float32)
+        self.phases = zeros(total, dtype=float32)
+        self.received = zeros(total, dtype=bool)
+
+    def add(self, correlation):
+        """ inst.add(correlation) -> None
+        Stores a single decoded correlation in its row."""
+        (corr_time, left, right, current, total,
+         lags, visibility, phase_fit, delay, phase) = correlation
+        self.baselines[current] = (left, right)
+        self.lags[current] = lags
+        self.visibilities[current] = visibility
+        self.phase_fits[current] = phase_fit
+        self.delays[current] = delay
+        self.phases[current] = phase
+        self.received[current] = True
+
+    @property
+    def complete(self):
+        return bool(self.received.all())
+
+    @property
+    def missing(self):
+        """ The rows (i.e. 'current' values) that were never received """
+        return [n for n in range(self.total) if not self.received[n]]
+
+    def index(self, baseline):
+        return self.baselines.index(baseline)
+
+    def __iter__(self):
+        for n in range(self.total):
+            if self.received[n]:
+                left, right = self.baselines[n]
+                yield (self.corr_time, left, right, n, self.total,
+                       self.lags[n], self.visibilities[n], self.phase_fits[n],
+                       float(self.delays[n]), float(self.phases[n]))
 
 
 class BEE2CorrelatorClient(BasicUDPClient):
 
-    def __init__(self, host, port, size=16):
-        BasicUDPClient.__init__(self, host, port)
+    _stages = ('pickup', 'read', 'process', 'send', 'network', 'total')
+
+    def __init__(self, host, port, size=16, multicast_group=None):
+        BasicUDPClient.__init__(self, host, port, multicast_group=multicast_group)
         self._header_struct = BEE2CorrelationProvider._header_struct
         self._header_size = BEE2CorrelationProvider._header_size
         self.visibs_size = len(zeros(size-1, dtype=complex).dumps())
@@ -283,34 +564,114 @@ class BEE2CorrelatorClient(BasicUDPClient):
         self.host, self.port = host, port
         self._stopevent = Event()
         self.size = size
+        self._pending = None
+        self.frames_received = 0
+        self.frames_incomplete = 0
+        self.packets_lost = 0
+        self.packets_malformed = 0
+        self.stage_latencies = dict((stage, Histogram()) for stage in self._stages)
 
     @debug
     def get_correlation(self):
         pkt = self._request('') # raises NoCorrelation if none ready
         self.logger.debug('received: %r' % pkt)
-        data = pkt[self._header_size:] # should be 3 arrays and 2 floats
-        corr_time, left, right, current, total = self._header_struct.unpack(pkt[:self._header_size])
-        lagss, visibss, fitss, m, c = self.unpacker.unpack(data)
-        return (
-            corr_time, left, right, current, total, # header information
-            loads(lagss), loads(visibss), loads(fitss), m, c # data
-            )
-
-    @debug
-    def _process(self):
-        try:
-            return self.get_correlation()
-        except NoCorrelations:
-            return None
+        return BEE2CorrelationProvider.unpack_packet(pkt, self.unpacker)
+
+    @debug
+    def get_frames(self):
+        """ inst.get_frames() -> [frame, ...]
+        Drains every packet queued on the socket and returns the
+        CorrelationFrame of each integration they complete. Packets of
+        an integration that is still arriving are kept for the next
+        call, unless packets of a newer integration show up first, in
+        which case its frame is handed out incomplete and the missing
+        packets are counted in inst.packets_lost. Packets that cannot be
+        decoded, whose 'current' field does not fit in their 'total', or
+        whose 'total' or number of lags disagrees with the rest of their
+        integration, are dropped and counted in inst.packets_malformed."""
+        frames = []
+        for pkt in self.drain():
+            received = time()
+            try:
+                correlation = BEE2CorrelationProvider.unpack_packet(pkt, self.unpacker)
+                stage_times = BEE2CorrelationProvider.unpack_stage_times(pkt)
+            except (ValueError, StructError, IndexError), err:
+                self.packets_malformed += 1
+                self.logger.warning('dropped undecodable packet of %d bytes: %s'
+                                    % (len(pkt), err))
+                continue
+            corr_time, current, total = correlation[0], correlation[3], correlation[4]
+            lags = len(correlation[5])
+            pending = self._pending
+            if not 0 <= current < total or (pending is not None and
+                    corr_time == pending.corr_time and
+                    (total != pending.total or lags != pending.lags.shape[1])):
+                self.packets_malformed += 1
+                self.logger.warning('dropped packet %d of %d at %f'
+                                    % (current, total, corr_time))
+                continue
+            if self._pending is not None and corr_time != self._pending.corr_time:
+                frames.append(self._finish_frame())
+            if self._pending is None:
+                self._pending = CorrelationFrame(corr_time, total, lags)
+            self._pending.add(correlation)
+            if stage_times is not None:
+                self._pending.stage_times = stage_times + (received,)
+            if self._pending.complete:
+                frames.append(self._finish_frame())
+        return frames
+
+    def _finish_frame(self):
+        frame, self._pending = self._pending, None
+        self.frames_received += 1
+        if not frame.complete:
+            missing = frame.missing
+            self.frames_incomplete += 1
+            self.packets_lost += len(missing)
+            self.logger.warning('integration at %f is missing packets %r'
+                                % (frame.corr_time, missing))
+        if frame.stage_times is not None:
+            dumped = frame.stage_times[0]
+            for stage, start, stop in zip(self._stages, frame.stage_times[:-1],
+                                          frame.stage_times[1:]):
+                self.stage_latencies[stage].record(max(0, int((stop - start)*1e6)))
+            self.stage_latencies['total'].record(max(0, int((frame.stage_times[-1] - dumped)*1e6)))
+        return frame
+
+    @debug
+    def get_stage_latencies(self):
+        """ inst.get_stage_latencies() -> {stage: (count, mean, p50, p99, max), ...}
+        Statistics, in seconds, of the time the frames received so far spent
+        in each stage between the integration finishing on the BEE2 and its
+        last packet arriving here: 'pickup' (noticing the dump), 'read'
+        (reading the BRAMs), 'process' (FFT and phase fit), 'send' (waiting
+        for and building the packets), 'network' (until received) and
+        'total'. The 'network' and 'total' stages compare clocks of two
+        hosts so they are only as good as their synchronization."""
+        stats = {}
+        for stage, histogram in self.stage_latencies.iteritems():
+            if histogram.total:
+                stats[stage] = (histogram.total, histogram.sum*1e-6/histogram.total,
+                                histogram.percentile(50)*1e-6, histogram.percentile(99)*1e-6,
+                                histogram.max*1e-6)
+        return stats
+
+    @debug
+    def _process(self, frame):
+        return frame
 
     @debug
     def _receive_loop(self, queue, period=1):
+        """ Sleeps on the socket (waking up at least every 'period'
+        seconds to check for a stop) and hands every frame it
+        completes to inst._process, non-None results are queued."""
         while not self._stopevent.isSet():
-            data = self._process()
-            if data is None:
-                self._stopevent.wait(period)
-            else:
-                queue.put_nowait(data)
+            if not self.wait(period):
+                continue
+            for frame in self.get_frames():
+                data = self._process(frame)
+                if data is not None:
+                    queue.put_nowait(data)
                 
     @debug
     def start(self, period=1):
@@ -339,9 +700,9 @@ class PhaseTracker(BEE2CorrelatorClient):
         self.phgran = 1 # degrees
         self.corrections = {}
         self.phases = {}
-        with RLock(): # do all server stuff here
+        with self.server._locks['state']:
             mapping = self.server._mapping.copy()
-            refinp = self._bee2.regread('refant')
+        refinp = self._bee2.regread('refant')
         rev_mapping = dict((v, k) for k, v in mapping.iteritems())
         self.refant = rev_mapping[refinp]
 
@@ -353,12 +714,13 @@ class PhaseTracker(BEE2CorrelatorClient):
     def _get_correction(self, phase_hist):
         return -phase_hist.mean()*(180/pi)
 
-    def _process(self):
-        try:
-            (corr_time, left, right, current, total,
-             lags, visibility, phase_fit, delay, phase) = self.get_correlation()
-        except NoCorrelations:
-            return None
+    def _process(self, frame):
+        for correlation in frame:
+            self._track(correlation)
+
+    def _track(self, correlation):
+        (corr_time, left, right, current, total,
+         lags, visibility, phase_fit, delay, phase) = correlation
         baseline = left, right
         refindex = baseline.index(self.refant) # obviously this only works if
         other = baseline[not refindex]         # the reference is part of the baseline
@@ -378,13 +740,12 @@ class PhaseTracker(BEE2CorrelatorClient):
         #        updated_delay = self.server.set_value('_delay_offsets', other, delay+old_delay)
         #    self.logger.info('corrected to {0:.4f} ns the delay of antenna {1}'.format(updated_delay, other))
         phase_correction = self._get_correction(phase_hist) # in degrees
-        with RLock():
-            itime = self._bee2.regread('integ_time')
+        itime = self._bee2.regread('integ_time')
         if self.corrections[other] is not None and \
                corr_time - self.corrections[other] < 3 * itime:
             return None # too soon to adjust phase again
         if abs(phase_correction) >= self.phgran: 
-            with RLock():
+            with self.server._locks['hardware'], self.server._locks['state']:
                 old_phase = self.server.get_value('_phase_offsets', other)
                 updated_phase = self.server.set_value('_phase_offsets', other, phase_correction+old_phase)
                 self.corrections[other] = corr_time
@@ -403,11 +764,27 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
                  correlator_bitstream='bee2_calib_corr.bof',
                  ipa_hosts=('169.254.128.3', '169.254.128.2'),
                  dbe_host='169.254.128.0', dds_host='128.171.116.189',
-                 correlator_client_port=8332, phase_tracker_port=9453):
+                 correlator_client_port=8332, phase_tracker_port=9453,
+                 multicast_group=None, register_verify='sampled',
+                 register_verify_every=8, register_max_age=60.0,
+                 tracker_lookahead=16, dds_refresh=20):
         """ SubmillimeterArrayTCPServer(address, handler, correlator, lags, baselines)
         This subclasses the BasicTCPServer and adds some methods needed for
         controlling and reading data from the BEE2CorrelationProvider. Please see 
-        the BasicTCPServer documentation for more detailed information."""
+        the BasicTCPServer documentation for more detailed information.
+
+        If multicast_group=(ip, port) is given the correlator also publishes
+        binary packets to that group, see BasicCorrelationProvider.set_multicast.
+
+        The delay, phase, gain and threshold registers of the IPAs are read
+        through a RegisterShadow, register_verify ('always', 'sampled' or
+        'never') decides how often a write is read back from the board and
+        the checks loop reconciles the shadows with the boards.
+
+        The delay tracker writes delays and phases precomputed for the next
+        tracker_lookahead periods from the last DDS query, the DDS itself is
+        queried every dds_refresh periods by a separate thread so that a slow
+        or absent DDS does not hold the writes up."""
         BasicTCPServer.__init__(self, address, handler=handler, 
                                 correlator=correlator, correlator_lags=correlator_lags, 
                                 antennas=antennas, initial_int_time=initial_int_time,
@@ -415,10 +792,22 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
                                 include_baselines=include_baselines)
         self._correlator = correlator(self, self._include_baselines, bee2_host, bee2_port, 
                                       lags=correlator_lags, bof=correlator_bitstream)
+        if multicast_group is not None:
+            self._correlator.set_multicast(multicast_group)
         self._correlator_client = BEE2CorrelatorClient('0.0.0.0', correlator_client_port)
         self.bee2_host, self.bee2_port, self.bee2_bitstream = bee2_host, bee2_port, correlator_bitstream
         self._delay_tracker_thread = Thread(target=self._delay_tracker)
+        self._dds_refresher_thread = Thread(target=self._dds_refresher)
         self._delay_tracker_stopevent = Event()
+        self._tracker_lookahead = tracker_lookahead
+        self._tracker_lateness = deque(maxlen=1024)
+        self._tracker_write_times = deque(maxlen=1024)
+        self._tracker_skipped = 0
+        self._dds_refresh = dds_refresh
+        self._dds_query = None
+        self._dds_query_time = None
+        self._dds_generation = 0
+        self._dds_ready = Event()
         self._checks_thread = Thread(target=self._checks_loop)
         self._checks_stopevent = Event()
         self._bee2 = BEE2Client(bee2_host, port=bee2_port)
@@ -433,6 +822,13 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
         self._ipas = {'ipa0': self._ipa0, 'ipa1': self._ipa1}
         self._ibobs = {'ipa0': self._ipa0, 'ipa1': self._ipa1, 'dbe': self._dbe}
         self._boards = {'ipa0': self._ipa0, 'ipa1': self._ipa1, 'dbe': self._dbe, 'bee2': self._bee2}
+        self._board_names = dict((board, name) for name, board in self._boards.iteritems())
+        self._fanout = BoardExecutor(self._boards, name='BoardFanout')
+        self._registers = dict(
+            (ipa, RegisterShadow(ipa, verify=register_verify, max_age=register_max_age,
+                                 verify_every=register_verify_every, name=name))
+            for name, ipa in self._ipas.iteritems()
+            )
         self._mapping = dict((a, i) for i, a in enumerate(self._antennas))#{6:0, 1:1, 2:2, 3:3, 4:4, 5:5, 7:6, 8:7}
         self._input_ibob_map = {0: [self._ipa0, 0], 1: [self._ipa0, 1],
                                 2: [self._ipa0, 2], 3: [self._ipa0, 3],
@@ -469,6 +865,14 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
                                   65 : self.set_dbe_gains,
                                   96 : self.operations_log,
                                   128 : self.get_correlation})
+        # everything but the mapping, reference antenna, logging and
+        # correlations goes out to the boards, the delay tracker command
+        # stops a thread that takes these locks itself
+        self._command_locks.update(dict.fromkeys(
+            (5, 6, 10, 11, 12, 13, 14, 15, 17, 18, 19,
+             36, 37, 38, 39, 40, 41, 42, 43, 64, 65), ('hardware', 'state')
+            ))
+        self._command_locks[7] = ()
         self.setup()
         #self.sync_all()
         self.start_checks_loop(30.0)
@@ -479,8 +883,21 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
         self.stop_checks_loop()
         self.stop_delay_tracker()
         self.stop_phase_tracker()
+        self._fanout.shutdown()
         return BasicTCPServer.shutdown(self, args)
 
+    def _on_boards(self, commands):
+        """ inst._on_boards(commands={board: [(function, arg, ...), ...]}) -> results
+        Runs the command lists of several boards in parallel, each board's
+        in order (see BoardExecutor), logs the boards that failed and raises
+        BoardErrors if any did."""
+        results, errors = self._fanout.run(commands)
+        for name, error in errors.iteritems():
+            self.logger.error('{0} failed: {1!r}'.format(name, error))
+        if errors:
+            raise BoardErrors(errors, results)
+        return results
+
     @info
     def reset_xaui(self, args):
         lev = BYTE.unpack(args[0])[0]
@@ -519,7 +936,7 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
 
     @info
     def _setup_fringe_stopping(self):
-        with RLock():
+        with self._locks['hardware']:
             queues = {}
             self._dds.query_dds(None)
             query = self._dds.query.copy()
@@ -550,7 +967,7 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
                 
     @debug
     def _sync_1pps(self):
-        with RLock():
+        with self._locks['hardware']:
             queues = {}
             for name, ibob in self._ibobs.iteritems():
                 queues[ibob] = ibob.tinysh('arm1pps')
@@ -562,7 +979,7 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
 
     @debug
     def _sync_sowf(self):
-        with RLock():
+        with self._locks['hardware']:
             queues = {}
             for name, ibob in self._ipas.iteritems():
                 queues[ibob] = ibob.tinysh('armsowf')
@@ -572,88 +989,183 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
                 # here instead of just logging about it
                 ibob.logger.info(last_line)
 
+    def _read_XAUI(self, board, regsep):
+        stats = {}
+        for xaui in ['xaui0', 'xaui1']:
+            prefix = xaui+regsep
+            stats[xaui] = [board.regread(prefix+reg) for reg in
+                           ('rx_linkdown', 'period', 'sync_cnt',
+                            'period_err_cnt', 'linkdown_cnt')]
+        return stats
+
     @debug
     def _check_XAUI(self):
-        boards = {'DBE': (self._dbe, '/'),
-                  'BEE': (self._bee2, '_')}
+        boards = {'DBE': ('dbe', '/'),
+                  'BEE': ('bee2', '_')}
+        msg = "{board}/{0}: (period {1})(syncs {2})(errors: {3})(linkdowns: {4})"
+        with self._locks['hardware']:
+            results, errors = self._fanout.run(dict(
+                (name, [(self._read_XAUI, self._boards[name], regsep)])
+                for name, regsep in boards.values()
+                ))
         for board_name, info in boards.iteritems():
-            board, regsep = info
-            msg = "{board}/{0}: (period {1})(syncs {2})(errors: {3})(linkdowns: {4})"
-            for xaui in ['xaui0', 'xaui1']:
-                prefix = xaui+regsep
-                with RLock():
-                    linkdown = board.regread(prefix+'rx_linkdown')
-                    period = board.regread(prefix+'period')
-                    sync_cnt = board.regread(prefix+'sync_cnt')
-                    period_err_cnt = board.regread(prefix+'period_err_cnt')
-                    linkdown_cnt = board.regread(prefix+'linkdown_cnt')
+            name, regsep = info
+            if name in errors:
+                self.logger.error('{board} XAUI check failed: {0!r}'.format(errors[name], board=board_name))
+                continue
+            for xaui, stats in sorted(results[name][0].iteritems()):
+                linkdown, period, sync_cnt, period_err_cnt, linkdown_cnt = stats
                 if linkdown:
                     self.logger.error('{board} {0} link is down!'.format(xaui, board=board_name))
-                board.logger.info(msg.format(xaui, period, sync_cnt, period_err_cnt,
-                                            linkdown_cnt, board=board_name))
+                self._boards[name].logger.info(msg.format(xaui, period, sync_cnt, period_err_cnt,
+                                                          linkdown_cnt, board=board_name))
 
     @info
     def setup(self):
-        self._setup_IPA(0)
-        self._setup_IPA(1)
-        self._setup_DBE()
-        self._setup_BEE2()
+        self._on_boards({'ipa0': [(self._setup_IPA, 0)],
+                         'ipa1': [(self._setup_IPA, 1)],
+                         'dbe': [(self._setup_DBE,)],
+                         'bee2': [(self._setup_BEE2,)]})
 
     @debug
     def sync_all(self):
         self._sync_1pps()
         self._sync_sowf()
 
+    @debug
+    def _reconcile_registers(self):
+        with self._locks['hardware']:
+            results, errors = self._fanout.run(dict(
+                (name, [(self._registers[ipa].reconcile,)])
+                for name, ipa in self._ipas.iteritems()
+                ))
+        # each divergence has already been logged (and corrected) by its shadow
+        for name in sorted(self._ipas):
+            if name in errors:
+                self.logger.error('{0} register check failed: {1!r}'.format(name, errors[name]))
+                continue
+            shadow = self._registers[self._ipas[name]]
+            shadow.logger.info(' '.join('(%s %d)' % item for item in sorted(shadow.stats.iteritems())))
+
     @info
     def run_checks(self):
         self._check_XAUI()
+        self._reconcile_registers()
+
+    def _set_on_boards(self, param, values):
+        """ inst._set_on_boards(param, values={antenna: value, ...}) -> None
+        Sets 'param' for every antenna, the antennas of each board in order
+        and the boards in parallel."""
+        commands = {}
+        for a in self._antennas:
+            ibob, ibob_input = self._input_ibob_map[self._mapping[a]]
+            board = self._board_names[ibob]
+            commands.setdefault(board, []).append((self.set_value, param, a, values[a]))
+        self._on_boards(commands)
 
     @debug
     def run_delay_tracker(self, delays):
-        for a in self._antennas:
-            self.set_value('_delays', a, delays[a])
+        self._set_on_boards('_delays', delays)
 
     @debug
     def run_fringe_stopper(self, phases):
-        for a in self._antennas:
-            self.set_value('_phases', a, phases[a])
+        self._set_on_boards('_phases', phases)
 
     @debug
     def _checks_loop(self):
         while not self._checks_stopevent.isSet():
-            with RLock():
+            with self._locks['state']:
                 checks_period = self._checks_period
             self.run_checks()
             self._checks_stopevent.wait(checks_period)
 
     @debug
-    def _delay_tracker(self):
-        count = 0
+    def _dds_refresher(self):
         logger = logging.getLogger("DelayTracker")
         while not self._delay_tracker_stopevent.isSet():
-            start = time()
-            if count%20 == 0:
-                try:
-                    self._dds.reconnect()
-                    self._dds.query_dds(None)
-                except:
+            with self._locks['state']:
+                refresh = self._delay_tracker_period * self._dds_refresh
+            try:
+                self._dds.reconnect()
+                self._dds.query_dds(None)
+            except:
+                if self._dds_query_time is None:
                     logger.error("Problem communicating with the DDS!")
-                    self._delay_tracker_stopevent.wait(20)
-                    continue
-            with RLock():
-                fstop = self._fstop
-                period = self._delay_tracker_period
-                delays = self._dds.get_delays(start+period)
-            phases = dict((a, sign(fstop)*(360*d*abs(fstop) % 360)) for a, d in delays.iteritems())
-            count += 1
-            while time() < start+period:
-                self._delay_tracker_stopevent.wait(period/10.)
-            with RLock():
-                self.run_delay_tracker(delays)
-                self.run_fringe_stopper(phases)
-            logger.info('|'.join('%d:%.2f'%(a, d) for a, d in delays.iteritems() if a in self._antennas))
-            #logger.info('|'.join('%d:%.2f'%(a, p) for a, p in phases.iteritems() if a in self._antennas))
-            
+                else:
+                    logger.error("Problem communicating with the DDS! (tracking with "
+                                 "a model %.1f s old)" % (time() - self._dds_query_time))
+                refresh /= 4. # retry sooner
+            else:
+                with self._locks['state']:
+                    self._dds_query = self._dds.query
+                    self._dds_query_time = time()
+                    self._dds_generation += 1
+                self._dds_ready.set()
+            self._delay_tracker_stopevent.wait(refresh)
+
+    def _trajectory(self, first, period, fstop):
+        """ inst._trajectory(first, period, fstop) -> times, delays, phases
+        The delays and phases of the next inst._tracker_lookahead ticks
+        starting at time 'first', from the last DDS query."""
+        with self._locks['state']:
+            query = self._dds_query
+        times = first + period*arange(self._tracker_lookahead)
+        delays, phases = self._dds.get_delay_model(times, fstop, query=query)
+        return times, delays, phases
+
+    @debug
+    def _delay_tracker(self):
+        logger = logging.getLogger("DelayTracker")
+        while not self._dds_ready.isSet():
+            if self._delay_tracker_stopevent.isSet():
+                return
+            self._dds_ready.wait(0.5)
+        with self._locks['state']:
+            period = self._delay_tracker_period
+        tick = ceil(time()/period)*period
+        times, model = None, None
+        while not self._delay_tracker_stopevent.isSet():
+            with self._locks['state']:
+                current = (self._dds_generation, self._fstop)
+            if times is None or model != current or tick > times[-1]:
+                times, delays, phases = self._trajectory(tick, period, current[1])
+                model = current
+            row = int(round((tick - times[0])/period))
+            self._delay_tracker_stopevent.wait(max(0, tick - time()))
+            if self._delay_tracker_stopevent.isSet():
+                break
+            started = time()
+            try:
+                with self._locks['hardware'], self._locks['state']:
+                    self.run_delay_tracker(dict(enumerate(delays[row])))
+                    self.run_fringe_stopper(dict(enumerate(phases[row])))
+            except BoardErrors:
+                logger.error("tracker tick at %.3f failed" % tick)
+            finished = time()
+            self._tracker_lateness.append(started - tick)
+            self._tracker_write_times.append(finished - started)
+            logger.info('|'.join('%d:%.2f'%(a, d) for a, d in enumerate(delays[row]) if a in self._antennas))
+            tick += period
+            if finished > tick: # the writes overran, skip the ticks already gone
+                skipped = int((finished - tick)/period) + 1
+                self._tracker_skipped += skipped
+                tick += skipped*period
+                logger.warning("writes took %.3f s, skipped %d tick(s)" % (finished - started, skipped))
+
+    @debug
+    def get_tracker_timing(self):
+        """ inst.get_tracker_timing() -> (mean, max, jitter, write_mean, write_max, skipped)
+        Statistics, in seconds, of how late the delay tracker started its
+        writes (jitter is the standard deviation of that lateness) and of
+        how long they took, over its last 1024 ticks, and the number of ticks
+        skipped because the writes overran."""
+        lateness = array(self._tracker_lateness)
+        writes = array(self._tracker_write_times)
+        if not len(lateness):
+            return None
+        return (lateness.mean(), lateness.max(), lateness.std(),
+                writes.mean(), writes.max(), self._tracker_skipped)
+
     @debug
     def start_checks_loop(self, period):
         self.logger.info('starting check loop at %s (period %.2f)' % (asctime(), period))
@@ -664,15 +1176,18 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
     def start_delay_tracker(self, period):
         self.logger.info('starting delay tracker at %s (period %.2f)' % (asctime(), period))
         self._delay_tracker_thread = Thread(target=self._delay_tracker)
+        self._dds_refresher_thread = Thread(target=self._dds_refresher)
         self._delay_tracker_stopevent.clear()
         self._delay_tracker_period = period
+        self._dds_refresher_thread.start()
         self._delay_tracker_thread.start()
 
     @debug
     def start_phase_tracker(self, period):
         self.logger.info('starting phase tracker at %s (period %.2f)' % (asctime(), period))
         self._phase_tracker = PhaseTracker(self, '0.0.0.0', self._phase_tracker_port)
-        self._correlator.add_subscriber(('0.0.0.0', self._phase_tracker_port))
+        self._correlator.add_subscriber(('0.0.0.0', self._phase_tracker_port),
+                                        BINARY_PACKET_VERSION)
         self._phase_tracker.start(period)
 
     @debug
@@ -685,6 +1200,8 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
         self._delay_tracker_stopevent.set()
         if self._delay_tracker_thread.isAlive():
             self._delay_tracker_thread.join()
+        if self._dds_refresher_thread.isAlive():
+            self._dds_refresher_thread.join()
 
     @debug
     def stop_phase_tracker(self):
@@ -715,12 +1232,40 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
 
     @info
     def clear_walsh_table(self, args):
+        blank = zeros(64, dtype=int)
+        commands = {}
         for name, ibob in self._ipas.iteritems():
-            for step in range(64):
-                ibob.bramwrite('walsh/table/90', 0, location=step)
-                ibob.bramwrite('walsh/table/180', 0, location=step)
+            commands[name] = [(ibob.bramwrite_block, 'walsh/table/90', blank),
+                              (ibob.bramwrite_block, 'walsh/table/180', blank)]
+        self._on_boards(commands)
         return SBYTE.pack(0)
 
+    def _walsh_columns(self, walsh_table):
+        """ inst._walsh_columns(walsh_table={antenna: steps, ...}) -> {ipa: (cur90, cur180)}
+        Packs the bottom (90 degree) and top (180 degree) bit of each step of
+        every antenna into its input's column of the 64 table words."""
+        steps, cols = {}, {}
+        for antenna, pattern in walsh_table.iteritems():
+            try:
+                ibob, col = self._input_ibob_map[self._mapping[antenna]]
+            except KeyError:
+                self.logger.warning("antenna %d not in array" % antenna)
+                continue
+            name = self._board_names[ibob]
+            steps.setdefault(name, []).append(pattern[:64])
+            cols.setdefault(name, []).append(col)
+        tables = {}
+        for name in self._ipas:
+            if name not in steps:
+                tables[name] = (zeros(64, dtype=int), zeros(64, dtype=int))
+                continue
+            pattern = array(steps[name], dtype=int)
+            col = array(cols[name], dtype=int)[:, newaxis]
+            cur90 = bitwise_or.reduce((pattern & 1) << col) # bottom bit
+            cur180 = bitwise_or.reduce(((pattern >> 1) & 1) << col) # top bit
+            tables[name] = (cur90, cur180)
+        return tables
+
     @info
     def load_walsh_table(self, args):
         try:
@@ -728,23 +1273,13 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
         except:
             self.logger.error("problem communicating with the DDS!")
             return SBYTE.pack(-1)
-        for step in range(64):
-            cur90 = dict.fromkeys(self._ipas.values(), 0)
-            cur180 = dict.fromkeys(self._ipas.values(), 0)
-            for antenna, steps in walsh_table.items():
-                try:
-                    ibob, col = self._input_ibob_map[self._mapping[antenna]]
-                except KeyError:
-                    self.logger.warning("antenna %d not in array" % antenna)
-                    walsh_table.pop(antenna)
-                    continue
-                bit90 = steps[step] & 1 # extract bottom bit
-                bit180 = (steps[step] >> 1) & 1 # extract top bit
-                cur90[ibob] = cur90[ibob] | (bit90 << col)
-                cur180[ibob] = cur180[ibob] | (bit180 << col)
-            for ibob in self._ipas.values():
-                ibob.bramwrite('walsh/table/90', cur90[ibob], location=step)
-                ibob.bramwrite('walsh/table/180', cur180[ibob], location=step)
+        tables = self._walsh_columns(walsh_table)
+        commands = {}
+        for name, ibob in self._ipas.iteritems():
+            cur90, cur180 = tables[name]
+            commands[name] = [(ibob.bramwrite_block, 'walsh/table/90', cur90),
+                              (ibob.bramwrite_block, 'walsh/table/180', cur180)]
+        self._on_boards(commands)
         return SBYTE.pack(0)
 
     @debug
@@ -752,14 +1287,14 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
         adc_per_ns = 1.024
         regname = 'delay%d' % ibob_input
         if mode=='get':
-            regvalue = ibob.regread(regname)
+            regvalue = self._registers[ibob].regread(regname)
             if regvalue < 64:
                 regvalue += 2**17
             return ((regvalue-64)/(16*adc_per_ns)) % (2**17)
         elif mode=='set':
             total = value + self._delay_offsets[antenna]
             regvalue = (round(16*adc_per_ns*total)+64) % (2**17)
-            ibob.regwrite(regname, int(regvalue))
+            self._registers[ibob].regwrite(regname, int(regvalue))
             return self._delay_handler('get', antenna, ibob, ibob_input)
 
     @debug
@@ -775,12 +1310,12 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
         deg_per_step = 360./2**12
         regname = 'phase%d' % ibob_input
         if mode=='get':
-            regvalue = ibob.regread(regname)
+            regvalue = self._registers[ibob].regread(regname)
             return regvalue * deg_per_step
         elif mode=='set':
             total = value + self._phase_offsets[antenna]
             regvalue = round(total/deg_per_step)
-            ibob.regwrite(regname, int(regvalue))
+            self._registers[ibob].regwrite(regname, int(regvalue))
             return self._phase_handler('get', antenna, ibob, ibob_input)
 
     @debug
@@ -795,20 +1330,20 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
     def _gain_handler(self, mode, antenna, ibob, ibob_input, value=None):
         regname = 'gain%d' % ibob_input
         if mode=='get':
-            regvalue = ibob.regread(regname)
+            regvalue = self._registers[ibob].regread(regname)
             return (regvalue % 256) * 2**-7
         elif mode=='set':
             regvalue = round(value * 2**7) % 256
-            ibob.regwrite(regname, int(regvalue))
+            self._registers[ibob].regwrite(regname, int(regvalue))
             return self._gain_handler('get', antenna, ibob, ibob_input)
 
     @debug
     def _thresh_handler(self, mode, antenna, ibob, ibob_input, value=None):
         regname = 'quant/thresh%d' % ibob_input
         if mode=='get':
-            return ibob.regread(regname)
+            return self._registers[ibob].regread(regname)
         elif mode=='set':
-            ibob.regwrite(regname, value)
+            self._registers[ibob].regwrite(regname, value)
             return self._thresh_handler('get', antenna, ibob, ibob_input)
 
     def get_value(self, param, antenna):
@@ -928,26 +1463,36 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
         If bool=False, selects external ADC data (normal)."""
         insel = unpack('!B', args[0])[0]
         seed = (randint(0, 2**16-1) << 16) + randint(0, 2**16-1)
-        for name, ibob in self._ipas.iteritems():
-            ibob.regwrite('noise/seed/0', seed)
-            ibob.regwrite('noise/seed/1', seed)
-            ibob.regwrite('noise/seed/2', seed)
-            ibob.regwrite('noise/seed/3', seed)
-        for name, ibob in self._ipas.iteritems():
-            ibob.regwrite('noise/arm', 0)
-        for name, ibob in self._ipas.iteritems():
-            ibob.regwrite('noise/arm', 0x1111)
-        for name, ibob in self._ipas.iteritems():
-            ibob.regwrite('insel', insel*0x55555555)
+        # every board is seeded and disarmed before any is armed
+        self._on_boards(dict(
+            (name, [(ibob.regwrite, 'noise/seed/0', seed),
+                    (ibob.regwrite, 'noise/seed/1', seed),
+                    (ibob.regwrite, 'noise/seed/2', seed),
+                    (ibob.regwrite, 'noise/seed/3', seed),
+                    (ibob.regwrite, 'noise/arm', 0)])
+            for name, ibob in self._ipas.iteritems()
+            ))
+        self._on_boards(dict(
+            (name, [(ibob.regwrite, 'noise/arm', 0x1111),
+                    (ibob.regwrite, 'insel', insel*0x55555555)])
+            for name, ibob in self._ipas.iteritems()
+            ))
         return SBYTE.pack(0)
 
+    def _tinysh(self, ibob, cmd):
+        response = ibob.tinysh(cmd).get()
+        ibob.logger.info(cmd)
+        return response
+
     @debug
     def _board(self, args):
         """ inst._board(board, cmd)
         This allows the client to send commands and receive
         responses from the server's underlying iBOBs. Note: this
         should be used cautiously, if you find yourself using this often
-        you should just write a server command."""
+        you should just write a server command. The register shadows of
+        the boards addressed are cleared, since the command may have
+        written any of their registers."""
         queues = {}
         board_re, sep, cmd = args.partition(' ')
         for name, board in self._boards.iteritems():
@@ -957,6 +1502,9 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
         for name, queue in queues.iteritems():
             response += queue.get(20)
             response += "\r### {0} {1} @({2})\n\r".format(name, cmd, asctime()) 
+            shadow = self._registers.get(self._boards[name])
+            if shadow is not None:
+                shadow.invalidate()
         return SBYTE.pack(0) + response
 
     @debug
@@ -982,20 +1530,22 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
     def start_fstopping(self, args):
         """ inst.start_fstopping() -> err_code
         Enable fringe stopping in the IPA iBOBs."""
-        for name, ibob in self._ipas.iteritems():
-            fstop_cmd = 'set_fstop {} 1'.format(int(self._fstop*10**5))
-            ibob.tinysh(fstop_cmd)
-            ibob.logger.info(fstop_cmd)
+        fstop_cmd = 'set_fstop {} 1'.format(int(self._fstop*10**5))
+        self._on_boards(dict(
+            (name, [(self._tinysh, ibob, fstop_cmd)])
+            for name, ibob in self._ipas.iteritems()
+            ))
         return pack('!b', 0)
 
     @debug
     def stop_fstopping(self, args):
         """ inst.stop_fstopping() -> err_code
         Disable fringe stopping in the IPA iBOBs."""
-        for name, ibob in self._ipas.iteritems():
-            fstop_cmd = 'set_fstop {} 0'.format(int(self._fstop*10**5))
-            ibob.tinysh(fstop_cmd)
-            ibob.logger.info(fstop_cmd)
+        fstop_cmd = 'set_fstop {} 0'.format(int(self._fstop*10**5))
+        self._on_boards(dict(
+            (name, [(self._tinysh, ibob, fstop_cmd)])
+            for name, ibob in self._ipas.iteritems()
+            ))
         return pack('!b', 0)
 
     def get_integration_time(self, args):
@@ -1030,8 +1580,10 @@ class SubmillimeterArrayTCPServer(BasicTCPServer):
 
 class SubmillimeterArrayClient(BasicInterfaceClient):
 
-    def __init__(self, host, port, timeout=10, corr_size=16):
-        BasicInterfaceClient.__init__(self, host, port, timeout=timeout)
+    def __init__(self, host, port, timeout=10, corr_size=16,
+                 persistent=False, extended=False):
+        BasicInterfaceClient.__init__(self, host, port, timeout=timeout,
+                                      persistent=persistent, extended=extended)
         self.visibs_size = len(zeros(corr_size-1, dtype=complex).dumps())
         self.lags_size = len(zeros(corr_size, dtype=complex).dumps())
         self.fits_size = len(zeros(corr_size-1).dumps())
@@ -1039,6 +1591,13 @@ class SubmillimeterArrayClient(BasicInterfaceClient):
             self.lags_size, self.visibs_size, self.fits_size
             ))
 
+    _parameters = dict(BasicInterfaceClient._parameters,
+                       mapping = (2, 3, 'B', BYTE_SIZE),
+                       delays = (36, 37, 'f', FLOAT_SIZE),
+                       phases = (38, 39, 'f', FLOAT_SIZE),
+                       gains = (40, 41, 'f', FLOAT_SIZE),
+                       thresholds = (42, 43, 'B', BYTE_SIZE))
+
     @debug
     def reset_xaui(self, lev=6):
         cmd = pack('!BB', 12, lev)
@@ -1118,14 +1677,7 @@ class SubmillimeterArrayClient(BasicInterfaceClient):
         if err:
             raise NoCorrelations
         self.logger.debug('received: %r' % pkt)
-        header_struct = BEE2CorrelationProvider._header_struct
-        data = pkt[header_struct.size:] # should be 3 arrays and 2 floats
-        corr_time, left, right, current, total = header_struct.unpack(pkt[:header_struct.size])
-        lagss, visibss, fitss, m, c = self.unpacker.unpack(data)
-        return (
-            corr_time, left, right, current, total, # header information
-            loads(lagss), loads(visibss), loads(fitss), m, c # data
-            )
+        return BEE2CorrelationProvider.unpack_packet(pkt, self.unpacker)
 
     @debug
     def load_walsh_table(self):
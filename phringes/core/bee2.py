@@ -9,12 +9,20 @@ import sys
 import logging
 import struct
 from Queue import Queue
+from threading import Event, Lock
 
+from numpy import dtype, frombuffer, empty, complex128, asarray
 from katcp import BlockingClient, Message
 
 from phringes.core.loggers import debug, info
 
 
+SIGNED_REG = struct.Struct('>i')
+UNSIGNED_REG = struct.Struct('>I')
+SIGNED_WORD = dtype('>i4')
+UNSIGNED_WORD = dtype('>u4')
+
+
 class NullHandler(logging.Handler):
     """ Emits nothing, useful for silencing annoying classes """
     def emit(self, record):
@@ -29,6 +37,13 @@ class BEE2Client(BlockingClient):
     def __init__(self, host, port=7147, tb_limit=20, timeout=10.0, retries=10):
         self._timeout = timeout
         self._retries = retries
+        self._pipeline_busy = Lock() # one request or pipeline at a time
+        self._pipeline_lock = Lock()
+        self._pipeline_stale = {} # name: replies still due from timed out pipelines
+        self._pipeline_done = Event()
+        self._pipeline_name = None
+        self._pipeline_replies = []
+        self._pipeline_expected = 0
         katcp_logger = logging.Logger("katcp")
         katcp_logger.addHandler(NullHandler())
         BlockingClient.__init__(self, host, port, tb_limit=tb_limit,
@@ -41,7 +56,10 @@ class BEE2Client(BlockingClient):
     def _request(self, name, *args, **kwargs):
         request = Message.request(name, *args)
         try:
-            reply, informs = self.blocking_request(request, keepalive=True)
+            # replies are only told apart by name, so a request must not
+            # overlap with a pipeline of the same request
+            with self._pipeline_busy:
+                reply, informs = self.blocking_request(request, keepalive=True)
         except TypeError:
             retry = kwargs.pop('retry', 0)
             self.logger.error("Error using blocking_request, try number %d" % retry)
@@ -53,6 +71,60 @@ class BEE2Client(BlockingClient):
                                % (request.name, request, reply))
         return reply, informs
 
+    @debug
+    def _pipelined_request(self, name, arglists):
+        """ inst._pipelined_request(name, [args, ...]) -> [reply, ...]
+        Sends one 'name' request per set of arguments without waiting
+        for any of the replies, then blocks until all of them have been
+        received. Replies are matched to requests in the order they were
+        sent, which is how tcpborphserver answers them. Other requests
+        wait for the pipeline to finish, replies arriving after it has
+        timed out are dropped."""
+        with self._pipeline_busy:
+            with self._pipeline_lock:
+                self._pipeline_done.clear()
+                self._pipeline_name = name
+                self._pipeline_replies = []
+                self._pipeline_expected = len(arglists)
+            for args in arglists:
+                self.request(Message.request(name, *args))
+            finished = self._pipeline_done.wait(self._timeout)
+            with self._pipeline_lock:
+                replies = self._pipeline_replies
+                self._pipeline_name = None
+                self._pipeline_replies = []
+                if not finished:
+                    self._pipeline_stale[name] = self._pipeline_stale.get(name, 0) +\
+                                                 len(arglists) - len(replies)
+        if not finished:
+            raise RuntimeError("Pipelined %s timed out after %s seconds, "
+                               "got %d of %d replies." % (name, self._timeout,
+                                                           len(replies), len(arglists)))
+        for args, reply in zip(arglists, replies):
+            if reply.arguments[0] != Message.OK:
+                self.logger.error("Request %s %r failed.\n  Reply: %s."
+                                  % (name, args, reply))
+                raise RuntimeError("Request %s %r failed.\n  Reply: %s."
+                                   % (name, args, reply))
+        return replies
+
+    def handle_reply(self, msg):
+        """ Overloaded to collect the replies of a pipelined request,
+        everything else is handed back to BlockingClient."""
+        with self._pipeline_lock:
+            if self._pipeline_stale.get(msg.name):
+                # answers come back in order, so these precede any newer ones
+                self._pipeline_stale[msg.name] -= 1
+                self.logger.warning("dropped late %s reply" % msg.name)
+                return
+            if self._pipeline_name is not None and msg.name == self._pipeline_name:
+                self._pipeline_replies.append(msg)
+                if len(self._pipeline_replies) == self._pipeline_expected:
+                    self._pipeline_name = None
+                    self._pipeline_done.set()
+                return
+        BlockingClient.handle_reply(self, msg)
+
     @debug
     def listbof(self):
         reply, informs = self._request("listbof")
@@ -82,37 +154,87 @@ class BEE2Client(BlockingClient):
     @debug
     def regread(self, device_name, signed=False):
         if signed:
-            fmt = ">i"
+            reg = SIGNED_REG
         else:
-            fmt = ">I"
+            reg = UNSIGNED_REG
         data = self._read(device_name, 4, 0)
-        return struct.unpack(fmt, data)[0]
+        return reg.unpack(data)[0]
 
     @debug
     def regwrite(self, device_name, integer, signed=False):
         if signed:
-            fmt = ">i"
+            reg = SIGNED_REG
         else:
-            fmt = ">I"
-        data = struct.pack(fmt, integer)
+            reg = UNSIGNED_REG
+        data = reg.pack(integer)
         self._write(device_name, data, 0)
 
-    @debug
     def bramread(self, device_name, size, offset=0, signed=True):
+        # logged by bramread_array, which does the actual read
+        return tuple(self.bramread_array(device_name, size, offset, signed).tolist())
+
+    @debug
+    def bramread_array(self, device_name, size, offset=0, signed=True):
+        """ inst.bramread_array(device_name, size) -> ndarray
+        Same as bramread but returns a read-only, big-endian NumPy
+        view over the bytes of the katcp reply instead of unpacking
+        every word into a Python tuple."""
         if signed:
-            fmt = ">%di" % size
+            word = SIGNED_WORD
         else:
-            fmt = ">%dI" % size
+            word = UNSIGNED_WORD
         data = self._read(device_name, size*4, offset=offset)
-        return struct.unpack(fmt, data)
+        return frombuffer(data, dtype=word)
 
     @debug
-    def bramwrite(self, device_name, integers, offset=0, signed=True):
+    def bramread_complex(self, real_name, imag_name, size, offset=0,
+                         signed=True, dtype=complex128):
+        """ inst.bramread_complex(real_name, imag_name, size) -> ndarray
+        Reads a pair of BRAMs holding the real and imaginary parts of
+        the same quantity and returns them fused into a single complex
+        array of the given dtype (complex64 or complex128)."""
+        return self.bramread_complex_batch([(real_name, imag_name)], size,
+                                           offset, signed, dtype)[0]
+
+    @debug
+    def bramread_complex_batch(self, pairs, size, offset=0,
+                               signed=True, dtype=complex128):
+        """ inst.bramread_complex_batch([(real, imag), ...], size) -> ndarray
+        Pipelined version of bramread_complex, returns an array of shape
+        (len(pairs), size) where row n holds the fused pairs[n]."""
+        names = [name for pair in pairs for name in pair]
+        block = self.bramread_batch(names, size, offset, signed)
+        out = empty((len(pairs), size), dtype=dtype)
+        for n, (real, imag) in enumerate(pairs):
+            out[n].real = block[real]
+            out[n].imag = block[imag]
+        return out
+
+    @debug
+    def bramread_batch(self, device_names, size, offset=0, signed=True):
+        """ inst.bramread_batch([name0, name1, ...], size) -> block
+        Reads 'size' words from each of the given BRAMs in a single
+        pipelined exchange and returns one NumPy structured record with
+        a field (of 'size' big-endian words) per device name, i.e.
+        block[name0] is what bramread(name0, size) would have returned."""
         if signed:
-            fmt = ">%di" % len(integers)
+            word = SIGNED_WORD
         else:
-            fmt = ">%dI" % len(integers)
-        data = struct.pack(fmt, *integers)
+            word = UNSIGNED_WORD
+        block_type = dtype([(name, word, (size,)) for name in device_names])
+        replies = self._pipelined_request(
+            "read", [(name, str(offset), str(size*4)) for name in device_names]
+        )
+        data = ''.join(reply.arguments[1] for reply in replies)
+        return frombuffer(data, dtype=block_type)[0]
+
+    @debug
+    def bramwrite(self, device_name, integers, offset=0, signed=True):
+        """ inst.bramwrite(device_name, integers, offset=0, signed=True) -> None
+        Writes a whole list or array of words in a single request, arrays
+        are converted to big-endian words without unpacking them."""
+        word = SIGNED_WORD if signed else UNSIGNED_WORD
+        data = asarray(integers).astype(word).tostring()
         self._write(device_name, data, offset=offset)
 
     @debug
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Worker threads for running blocking calls (mostly hardware
+I/O) off the thread that asked for them
+
+"""
+
+
+import sys
+import logging
+
+from threading import Thread, Event, Lock
+from Queue import Queue, Empty
+
+
+__all__ = [ 'Future', 'BoundedExecutor', 'BoardExecutor', 'BoardErrors' ]
+
+
+class Future(object):
+    """ The eventual result of a call handed to a BoundedExecutor.
+
+    It can be used wherever one of the Queues returned by the asynchronous
+    client calls is expected: inst.get() blocks until the call has finished
+    and returns its result (or re-raises the exception it raised). Unlike a
+    Queue the result stays available, so it may be read more than once."""
+
+    def __init__(self):
+        self._done = Event()
+        self._lock = Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        """ inst.set_exception(exc_info=sys.exc_info()) -> None """
+        self._exc_info = exc_info
+        self._finish()
+
+    def done(self):
+        return self._done.isSet()
+
+    def add_done_callback(self, callback):
+        """ inst.add_done_callback(callback) -> None
+        Calls callback(inst) once the result is ready, from the thread that
+        set it (or right away if it is ready already)."""
+        with self._lock:
+            if not self._done.isSet():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def get(self, block=True, timeout=None):
+        """ inst.get(block=True, timeout=None) -> result
+        Same semantics as Queue.get, raises Queue.Empty if the result is not
+        ready in time."""
+        if not block:
+            timeout = 0
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise Empty
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class BoundedExecutor:
+    """ A fixed number of worker threads running submitted calls in the
+    order they were submitted. With a single worker the calls are also
+    serialized, which is how a board link can be given its own thread."""
+
+    def __init__(self, workers=4, name='BoundedExecutor', maxsize=0):
+        """ BoundedExecutor(workers=4, name, maxsize=0) -> inst
+        Starts 'workers' daemon threads; if maxsize is non-zero inst.submit
+        blocks while that many calls are already waiting."""
+        self.logger = logging.getLogger(name)
+        self._jobs = Queue(maxsize=maxsize)
+        self._threads = []
+        for i in range(workers):
+            thread = Thread(target=self._work, name='%s-%d' % (name, i))
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            future, function, args, kwargs = job
+            try:
+                result = function(*args, **kwargs)
+            except:
+                self.logger.exception('%r failed' % function)
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+
+    @property
+    def pending(self):
+        return self._jobs.qsize()
+
+    def submit(self, function, *args, **kwargs):
+        """ inst.submit(function, *args, **kwargs) -> Future
+        Queues function(*args, **kwargs) to be run by the next free worker."""
+        future = Future()
+        self._jobs.put((future, function, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        """ inst.shutdown(wait=True) -> None
+        Lets the workers finish the calls already submitted and stops them."""
+        for thread in self._threads:
+            self._jobs.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class BoardErrors(Exception):
+    """ Raised for a BoardExecutor run in which some boards failed, holds
+    the exception of each failed board in inst.errors and the results of
+    the commands that did run in inst.results."""
+
+    def __init__(self, errors, results):
+        Exception.__init__(self, ', '.join(
+            '%s: %r' % (name, error) for name, error in sorted(errors.items())
+            ))
+        self.errors = errors
+        self.results = results
+
+
+class BoardExecutor:
+    """ Runs lists of commands for several boards at the same time. Each
+    board has its own worker thread so that its commands run in order, and
+    a run takes as long as its slowest board rather than the sum of them.
+    Commands must not start a run of their own."""
+
+    def __init__(self, names, name='BoardExecutor'):
+        self._executors = dict(
+            (board, BoundedExecutor(1, name='%s(%s)' % (name, board)))
+            for board in names
+            )
+
+    def _run_list(self, commands):
+        results = []
+        try:
+            for command in commands:
+                results.append(command[0](*command[1:]))
+        except:
+            return results, sys.exc_info()[1]
+        return results, None
+
+    def run(self, commands):
+        """ inst.run(commands={board: [(function, arg, ...), ...], ...}) -> results, errors
+        Runs each board's commands in order, all boards in parallel, and
+        waits for them. 'results' maps each board to the return values of
+        its commands, 'errors' maps the boards that failed to the exception
+        raised (a board stops at its first failing command)."""
+        futures = dict(
+            (board, self._executors[board].submit(self._run_list, board_commands))
+            for board, board_commands in commands.iteritems() if board_commands
+            )
+        results, errors = {}, {}
+        for board, future in futures.iteritems():
+            results[board], error = future.get()
+            if error is not None:
+                errors[board] = error
+        return results, errors
+
+    def check(self, commands):
+        """ inst.check(commands) -> results
+        Same as inst.run but raises BoardErrors if any board failed."""
+        results, errors = self.run(commands)
+        if errors:
+            raise BoardErrors(errors, results)
+        return results
+
+    def shutdown(self):
+        for executor in self._executors.values():
+            executor.shutdown()
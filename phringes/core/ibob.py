@@ -4,8 +4,11 @@ Classes for communicating with iBOB hardware over TCP/IP
 
 
 import re
+import sys
 import logging
 
+from threading import Thread, Event, Lock, currentThread
+from Queue import Queue, Full
 from socket import error as SocketError
 from socket import timeout as SocketTimeout
 from socket import (
@@ -15,7 +18,8 @@ from socket import (
 
 from phringes.core.loggers import debug, info
 from phringes.core.macros import int_
-from phringes.backends.basic import BasicTCPClient
+from phringes.core.executor import Future
+from phringes.backends.basic import BasicTCPClient, BasicNetworkError
 
 
 MAX_REQUEST_SIZE = 4096
@@ -23,59 +27,273 @@ MAX_REQUEST_SIZE = 4096
 
 class IBOBClient(BasicTCPClient):
     """ Interface to a single iBOB running lwIP
+
+    Commands are not sent from the calling thread but queued for the
+    board's worker thread, so the delay tracker, checks loop, handlers,
+    etc. can share one board without interleaving on its socket. With
+    connections=N the board gets N lwIP connections, each with its own
+    worker taking commands from the same queue.
+
+    The *_async methods (and tinysh) return a Future whose get() returns
+    the result, the other methods wait for it. A register read or bramdump
+    that is still queued is shared by identical reads queued after it,
+    unless a write to the same device was queued in between.
     """
 
-    def __init__(self, host, port, timeout=3):
+    bulk_chunk = 32 # bramwrite lines sent per acknowledgement
+
+    def __init__(self, host, port, timeout=3, connections=1):
         BasicTCPClient.__init__(self, host, port, timeout=timeout)
         self.ack_trans = '\x06\n', '\rno match: \x06\n\r'
+        self._queue = Queue()
+        self._pending = {} # queued reads by (command, args)
+        self._pending_lock = Lock()
+        self._streams = [] # (consumer thread, cancel event) of running streams
+        self._links = [self]
+        for i in range(connections-1):
+            link = BasicTCPClient(host, port, timeout=timeout)
+            link.ack_trans = self.ack_trans
+            link.logger = self.logger
+            self._links.append(link)
+        self._workers = []
+        for n, link in enumerate(self._links):
+            worker = Thread(target=self._work, args=[link],
+                            name='%s:%d' % (host, n))
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
 
-    @debug
-    def regread(self, device_name):
+    def _work(self, link):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            future, key, function, args = job
+            if key is not None:
+                with self._pending_lock:
+                    if self._pending.get(key) is future:
+                        del self._pending[key]
+            try:
+                result = function(link, *args)
+            except:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+
+    def _submit(self, function, *args, **kwargs):
+        """ _submit(function, *args, key=None, writes=None) -> Future
+        Queues function(link, *args) for the next free worker. Jobs with the
+        same key while the first is still queued share its Future. A job
+        that writes the device named by 'writes' keeps the reads of it
+        queued after it from sharing the ones queued before."""
+        key = kwargs.get('key')
+        writes = kwargs.get('writes')
+        with self._pending_lock:
+            self._check_streams()
+            if writes is not None:
+                for pending in self._pending.keys():
+                    if pending[1] == writes:
+                        del self._pending[pending]
+            if key is None:
+                future = Future()
+            else:
+                future = self._pending.get(key)
+                if future is not None:
+                    return future
+                future = self._pending[key] = Future()
+            self._queue.put((future, key, function, args))
+        return future
+
+    def _check_streams(self):
+        # a thread reading a stream that occupies every worker would wait
+        # forever for its own command, the stream only finishes once read
+        consumer = currentThread()
+        streaming = [thread for thread, cancel in self._streams if not cancel.isSet()]
+        if consumer in streaming and len(streaming) >= len(self._links):
+            raise RuntimeError, "board is busy streaming to this thread, " \
+                                "finish or close the stream first"
+
+    def _stream(self, function, *args):
+        """ _stream(function, *args) -> iterator
+        Runs the generator function(link, *args) on a worker and hands its
+        items over through a small queue as they are produced. The job is
+        only queued once the iterator is first advanced, and closing or
+        dropping the iterator early stops the generator (which lets it
+        clean up). Until the generator is done the thread reading the
+        stream must not wait on other commands for this board when the
+        stream holds the last free connection (see _check_streams)."""
+        items = Queue(maxsize=256)
+        cancel = Event()
+        def put(item):
+            while not cancel.isSet():
+                try:
+                    items.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+        def job(link, consumer, *args):
+            try:
+                generator = function(link, *args)
+                try:
+                    for item in generator:
+                        if not put((False, item)):
+                            return
+                except:
+                    put((True, sys.exc_info()))
+                    raise
+                finally:
+                    generator.close()
+                put((True, None))
+            finally:
+                with self._pending_lock:
+                    self._streams.remove((consumer, cancel))
+        def consume():
+            consumer = currentThread()
+            with self._pending_lock:
+                self._check_streams()
+                self._streams.append((consumer, cancel))
+                self._queue.put((Future(), None, job, (consumer,) + args))
+            try:
+                while True:
+                    last, item = items.get()
+                    if last:
+                        if item is not None:
+                            raise item[0], item[1], item[2]
+                        return
+                    yield item
+            finally:
+                cancel.set()
+        return consume()
+
+    def _regread(self, link, device_name):
         retparser = lambda buf: int(buf.split()[-1].lstrip('0') or '0')
-        return self._command('regread', [device_name], {}, 
+        return link._command('regread', [device_name], {},
                              "{0}", retparser, 63)
 
-    @debug
-    def regwrite(self, device_name, integer):
+    def _regwrite(self, link, device_name, integer):
         retparser = lambda buf: None
-        return self._command('regwrite', [device_name, integer], {},
+        return link._command('regwrite', [device_name, integer], {},
                              "{0} {1}", retparser, 1)
 
-    @debug
-    def bramdump_iter(self, device_name, length, start=0, signed=True):
-        retparser = lambda buf: iter(
-            int_(i, 16, signed) for i in buf.split('\n') if i!='\r'
-        )
-        return self._command(
+    def _bramdump_iter(self, link, device_name, length, start, signed):
+        lines = link._command_iter(
             'bramdump', [device_name, length, start], {'loc': start},
-            "{0} {loc} {1}", retparser, 12*length+1
+            "{0} {loc} {1}"
         )
+        try:
+            for line in lines:
+                if line!='\r':
+                    yield int_(line, 16, signed)
+        finally:
+            lines.close()
 
-    @debug
-    def bramdump(self, device_name, length, start=0, signed=True):
-        return list(self.bramdump_iter(device_name, length, start, signed))
+    def _bramdump(self, link, device_name, length, start, signed):
+        for tries in range(self.retries):
+            try:
+                return list(self._bramdump_iter(link, device_name, length, start, signed))
+            except (BasicNetworkError, SocketError, ValueError):
+                self.logger.error("errors occured, retrying...")
+        self.logger.error("exheeded retry count!")
 
-    @debug
-    def bramwrite(self, device_name, integer, location=0):
+    def _bramwrite(self, link, device_name, integer, location):
         retparser = lambda buf: None
-        return self._command(
+        return link._command(
             'bramwrite', [device_name, integer], {'loc': location},
             "{0} {loc} {1}", retparser, 0
         )
 
+    def _bramwrite_block(self, link, device_name, integers, location):
+        # a chunk of bramwrite lines is sent before reading their acks, which
+        # keeps the iBOB's small lwIP buffers from overflowing
+        cmd = link.cmdfmt.format(cmd='bramwrite', args='{0} {1} {2}')
+        integers = [int(i) for i in integers]
+        for start in range(0, len(integers), self.bulk_chunk):
+            chunk = integers[start:start+self.bulk_chunk]
+            lines = link.ack_trans[0].join(
+                cmd.format(device_name, location+start+i, integer)
+                for i, integer in enumerate(chunk)
+                )
+            for tries in range(self.retries):
+                try:
+                    link._request(lines, 0, len(chunk))
+                    break
+                except (BasicNetworkError, SocketError):
+                    self.logger.error("errors occured, reconnecting...")
+                    try:
+                        link.reconnect()
+                    except SocketTimeout:
+                        pass
+            else:
+                self.logger.error("exheeded retry count!")
+                raise BasicNetworkError, "could not write %s" % device_name
+
+    def _call(self, link, cmd, args, argfmt, retparser, retsize):
+        return link._command(cmd, args, {}, argfmt, retparser, retsize)
+
+    @debug
+    def regread(self, device_name):
+        return self.regread_async(device_name).get()
+
+    def regread_async(self, device_name):
+        return self._submit(self._regread, device_name,
+                            key=('regread', device_name))
+
+    @debug
+    def regwrite(self, device_name, integer):
+        return self.regwrite_async(device_name, integer).get()
+
+    def regwrite_async(self, device_name, integer):
+        return self._submit(self._regwrite, device_name, integer,
+                            writes=device_name)
+
+    @debug
+    def bramdump_iter(self, device_name, length, start=0, signed=True):
+        """ Lazily reads the BRAM, each word is parsed as its line arrives.
+        The worker reading it only moves on to the next command once the
+        iterator is exhausted or dropped."""
+        return self._stream(self._bramdump_iter, device_name, length, start, signed)
+
+    @debug
+    def bramdump(self, device_name, length, start=0, signed=True):
+        return self.bramdump_async(device_name, length, start, signed).get()
+
+    def bramdump_async(self, device_name, length, start=0, signed=True):
+        return self._submit(self._bramdump, device_name, length, start, signed,
+                            key=('bramdump', device_name, length, start, signed))
+
+    @debug
+    def bramwrite(self, device_name, integer, location=0):
+        return self.bramwrite_async(device_name, integer, location).get()
+
+    def bramwrite_async(self, device_name, integer, location=0):
+        return self._submit(self._bramwrite, device_name, integer, location,
+                            writes=device_name)
+
+    @debug
+    def bramwrite_block(self, device_name, integers, location=0):
+        """ Writes a list or array of words starting at 'location' with a
+        round trip per inst.bulk_chunk words instead of one per word."""
+        return self.bramwrite_block_async(device_name, integers, location).get()
+
+    def bramwrite_block_async(self, device_name, integers, location=0):
+        return self._submit(self._bramwrite_block, device_name, integers, location,
+                            writes=device_name)
+
     @debug
     def get_phase_offset(self, input):
         ret_re = '[\r\n]+PO(?P<input>\d)(?:\=)(?P<phase_int>\-*?\d+).\-*(?P<phase_fl>\d+)[\r\n]+'
         def retparser(buf):
             m = re.match(ret_re, buf).groupdict()
             return float(m['phase_int']) + float(m['phase_fl'])*10**-5
-        return self._command('get_phase_offset', [input], {}, '{0}', retparser, None)
+        return self._submit(self._call, 'get_phase_offset', [input], '{0}',
+                            retparser, None).get()
 
     @debug
     def set_phase_offset(self, input, value):
         retparser = lambda buf: None
-        return self._command('set_phase_offset', [input, int(value*10**5)], {},
-                             '{0} {1}', retparser, 1)
+        return self._submit(self._call, 'set_phase_offset', [input, int(value*10**5)],
+                            '{0} {1}', retparser, 1).get()
 
     @debug
     def get_delay_offset(self, input):
@@ -83,19 +301,27 @@ class IBOBClient(BasicTCPClient):
         def retparser(buf):
             m = re.match(ret_re, buf).groupdict()
             return float(m['delay_int']) + float(m['delay_fl'])*10**-5
-        return self._command('get_delay_offset', [input], {}, '{0}', retparser, None)
+        return self._submit(self._call, 'get_delay_offset', [input], '{0}',
+                            retparser, None).get()
 
     @debug
     def set_delay_offset(self, input, value):
         retparser = lambda buf: None
-        return self._command('set_delay_offset', [input, int(value*10**5)], {},
-                             '{0} {1}', retparser, 1)
+        return self._submit(self._call, 'set_delay_offset', [input, int(value*10**5)],
+                            '{0} {1}', retparser, 1).get()
 
     @debug
     def tinysh(self, command):
         retparser = lambda buf: buf
-        return self._async_command(command, [], {}, "", retparser, 1)
+        return self._submit(self._call, command, [], "", retparser, 1)
 
     @debug
     def close(self):
-        self._close_socket()
+        """ Lets the workers finish the queued commands and closes every
+        connection to the board."""
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        for link in self._links:
+            link._close_socket()
@@ -7,6 +7,8 @@ import logging
 from time import time
 from functools import wraps
 
+from phringes.core.metrics import timings
+
 
 CHAR_MAP = '?'*32 + ''.join(chr(c) for c in range(32, 256))
 
@@ -28,7 +30,11 @@ class LoggingDecorator:
     DEBUG:Foo:bar(1, 2) => 3
     
     Note: if the class object wants to do its own logging it should 
-    use logging.getLogger within its constructor."""
+    use logging.getLogger within its constructor.
+
+    When the logger is not enabled for the level nothing is formatted and
+    the method is called directly. If phringes.core.metrics.timings is
+    enabled the calls are also counted and timed there."""
     #pylint: disable=R0903
 
     def __init__(self, level):
@@ -36,16 +42,35 @@ class LoggingDecorator:
 
     def __call__(self, method):
         method_name = method.__name__
+        level = self.level
 
         @wraps(method)
         def wrapped(inst, *args, **kwargs):
             """ This decorated function should have the same docstring
             and name as the original function its deocratin."""
+            try:
+                logger = inst.logger
+            except AttributeError:
+                logger = logging.getLogger(inst.__class__.__name__)
+            timed = False
+            if timings.enabled:
+                key = (inst.__class__.__name__, method_name)
+                timed = timings.count(key)
+            if not logger.isEnabledFor(level):
+                if not timed:
+                    return method(inst, *args, **kwargs)
+                start_func = time()
+                response = method(inst, *args, **kwargs)
+                timings.record(key, time()-start_func)
+                return response
+
             start_logger = time()
 
             start_func = time()
             response = method(inst, *args, **kwargs)
             stop_func = time()
+            if timed:
+                timings.record(key, stop_func-start_func)
 
             argstr = ', '.join(repr(i) for i in args)
             kwargstr = ', '.join(
@@ -59,7 +84,7 @@ class LoggingDecorator:
                 arg_kwarg = argstr
             else:
                 arg_kwarg = ''
-            if response != None:
+            if response is not None:
                 msg = "%s(%s) => %s" % (method_name, arg_kwarg, repr(response))
             else:
                 msg = "%s(%s)" % (method_name, arg_kwarg)
@@ -69,11 +94,7 @@ class LoggingDecorator:
             logger_time = (stop_logger-start_logger)*1000
             msg += "    [%.3f ms][%.3f ms]" % (func_time, logger_time)
             msg = msg.translate(CHAR_MAP) # remove special chars
-            try:
-                inst.logger.log(self.level, msg)
-            except AttributeError:
-                logger = logging.getLogger(inst.__class__.__name__)
-                logger.log(self.level, msg)
+            getattr(inst, 'logger', logger).log(level, msg) # __init__ sets it
             
             return response
 
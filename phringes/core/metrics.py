@@ -0,0 +1,197 @@
+"""
+Aggregated call timings of the methods wrapped by the logging
+decorators (see phringes.core.loggers)
+"""
+
+
+from threading import Lock, local, currentThread
+
+
+__all__ = [ 'Histogram', 'MethodTimings', 'timings' ]
+
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Histogram:
+    """ An HDR-style histogram of non-negative integers (latencies in
+    microseconds here). Values below 2**bits have a bucket each, above
+    that every power of two range is split into 2**(bits-1) equal buckets,
+    so a value is known to a relative precision of 2**(1-bits) whatever
+    its magnitude while the histogram stays small."""
+
+    def __init__(self, bits=6):
+        self.bits = bits
+        self.half = 1 << (bits-1)
+        self.counts = []
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - self.bits
+        if shift <= 0:
+            return value
+        return shift*self.half + (value >> shift)
+
+    def _highest(self, index):
+        """ The largest value that falls in bucket 'index' """
+        shift = index // self.half - 1
+        if shift <= 0:
+            return index
+        return ((index - shift*self.half + 1) << shift) - 1
+
+    def record(self, value):
+        index = self._index(value)
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0]*(index + 1 - len(counts)))
+        counts[index] += 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ inst.merge(other) -> None
+        Adds the counts of another histogram with the same bits."""
+        counts = list(other.counts)
+        if len(counts) > len(self.counts):
+            self.counts.extend([0]*(len(counts) - len(self.counts)))
+        for index, count in enumerate(counts):
+            self.counts[index] += count
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """ inst.percentile(percent) -> value
+        The value below which 'percent' of the recorded values fall (to
+        the precision of the buckets)."""
+        if not self.total:
+            return 0
+        wanted = max(1, percent/100.*self.total)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(self._highest(index), self.max)
+        return self.max
+
+
+class MethodTimings:
+    """ Call counts and latency histograms per class and method.
+
+    While disabled (the default) the decorators only log. Once enabled
+    every call is counted and one call in 'sample' is also timed into a
+    Histogram of microseconds.
+
+    Each thread records into its own counters and histograms so calls are
+    counted without taking a lock, inst.snapshot merges them. The shards of
+    threads that have exited are folded together whenever a new thread
+    starts recording, so short-lived handler threads do not pile up."""
+
+    def __init__(self, bits=6):
+        self.enabled = False
+        self.sample = 1
+        self.bits = bits
+        self._lock = Lock()
+        self._local = local()
+        self._shards = [] # (thread, {(class, method): [calls, histogram]})
+        self._retired = {} # merged shards of threads that have exited
+        self._generation = 0 # bumped by inst.reset to retire every shard
+
+    def enable(self, sample=1):
+        """ inst.enable(sample=1) -> None
+        Starts counting calls and timing one in every 'sample' of them."""
+        self.sample = max(1, int(sample))
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """ inst.reset() -> None
+        Forgets everything recorded so far, each thread starts a fresh shard
+        on its next call rather than having its current one cleared under
+        it."""
+        with self._lock:
+            self._shards = []
+            self._retired = {}
+            self._generation += 1
+
+    def _prune(self):
+        # the caller holds inst._lock
+        alive = []
+        for thread, shard in self._shards:
+            if thread.isAlive():
+                alive.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+        self._shards = alive
+
+    def _shard(self):
+        local = self._local
+        if getattr(local, 'generation', None) == self._generation:
+            return local.shard
+        shard = {}
+        with self._lock:
+            self._prune()
+            self._shards.append((currentThread(), shard))
+            local.shard, local.generation = shard, self._generation
+        return shard
+
+    def count(self, key):
+        """ inst.count(key=(class, method)) -> bool
+        Counts a call and returns whether it should be timed."""
+        shard = self._shard()
+        stats = shard.get(key)
+        if stats is None:
+            stats = shard[key] = [0, Histogram(self.bits)]
+        stats[0] += 1
+        return stats[0] % self.sample == 0
+
+    def record(self, key, seconds):
+        """ inst.record(key=(class, method), seconds) -> None """
+        shard = self._shard()
+        stats = shard.get(key)
+        if stats is None:
+            stats = shard[key] = [0, Histogram(self.bits)]
+        stats[1].record(int(seconds*1e6))
+
+    def _merge(self, merged, shard):
+        for key, (calls, histogram) in shard.items():
+            stats = merged.get(key)
+            if stats is None:
+                stats = merged[key] = [0, Histogram(self.bits)]
+            stats[0] += calls
+            stats[1].merge(histogram)
+
+    def snapshot(self, prefix=''):
+        """ inst.snapshot(prefix='') -> {'class.method': stats, ...}
+        Merges the statistics of every thread, for the methods whose name
+        starts with 'prefix'. Each stats dictionary holds the number of
+        'calls' and of 'timed' calls and, in seconds, the 'mean' and 'max'
+        latency and the 'p50', 'p90', 'p99' and 'p99.9' percentiles."""
+        with self._lock:
+            self._prune()
+            alive = list(self._shards)
+            merged = {}
+            self._merge(merged, self._retired)
+        for thread, shard in alive:
+            self._merge(merged, shard)
+        stats = {}
+        for (cls, method), (calls, histogram) in merged.iteritems():
+            name = '%s.%s' % (cls, method)
+            if not name.startswith(prefix):
+                continue
+            timed = histogram.total
+            stats[name] = {'calls': calls, 'timed': timed,
+                           'mean': timed and histogram.sum*1e-6/timed,
+                           'max': histogram.max*1e-6}
+            for percent in PERCENTILES:
+                stats[name]['p%g' % percent] = histogram.percentile(percent)*1e-6
+        return stats
+
+
+timings = MethodTimings()
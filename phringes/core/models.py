@@ -2,7 +2,7 @@
 
 
 import logging
-from numpy import arange, sinc, resize, insert, dot, hamming, sqrt
+from numpy import arange, sinc, resize, insert, dot, hamming, sqrt, zeros
 from numpy.random import normal
 
 from phringes.core.loggers import debug
@@ -14,11 +14,17 @@ __all__ = ['Model',
 
 
 class Model:
+    """ Per-baseline delay and phase contributions. inst.delay(baseline)
+    and inst.phase(baseline) step one baseline at a time, inst.delays()
+    and inst.phases() step all of the server's included baselines at once
+    and return them as arrays in that order (the two kinds keep separate
+    states)."""
 
     @debug
     def __init__(self, server):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.server = server
+        self._n_baselines = len(self.server._include_baselines)
         self._delay = dict((b, self._delay_generator(b)) 
                            for b in self.server._include_baselines)
         self._phase = dict((b, self._phase_generator(b)) 
@@ -44,6 +50,12 @@ class Model:
     def phase(self, baseline):
         return self._phase[baseline].next()
 
+    def delays(self):
+        return zeros(self._n_baselines)
+
+    def phases(self):
+        return zeros(self._n_baselines)
+
 
 class GeometricModel(Model):
 
@@ -55,19 +67,33 @@ class GeometricModel(Model):
 class AtmosphericModel(Model):
 
     #@debug
-    def __init__(self, server):
+    def __init__(self, server, B=1/64.):
         self.t = None
         self.coeffs = None
         self.normcoeffs = None
         Model.__init__(self, server)
+        self._set_filter(B)
+        self._white_noise = normal(0, 1, (self._n_baselines, len(self.normcoeffs)))
 
-    #@debug
-    def _phase_generator(self, baseline, B=1/64.):
+    def _set_filter(self, B):
         edge = round(16./B)
         self.t = arange(-edge, 1+edge)
         self.coeffs = 2*B*sinc(2*B*self.t) *\
                       hamming(len(self.t))
         self.normcoeffs = self.coeffs/sqrt(sum(self.coeffs**2))
+
+    def phases(self):
+        """ inst.phases() -> array
+        Low-pass filtered white noise phases (rads) of every baseline, the
+        same process as inst._phase_generator with one row of state per
+        baseline."""
+        self._white_noise[:, 1:] = self._white_noise[:, :-1].copy() # shift in time
+        self._white_noise[:, 0] = normal(0, 1, self._n_baselines)
+        return dot(self._white_noise, self.normcoeffs)
+
+    #@debug
+    def _phase_generator(self, baseline, B=1/64.):
+        self._set_filter(B)
         white_noise = normal(0, 1, len(self.normcoeffs))
         while True:
             white_noise = resize(insert(white_noise, 0, normal(0, 1)),
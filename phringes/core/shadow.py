@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+A write-through cache of the registers written to a board, so that
+reading back a value that was just set does not have to go out to
+the hardware every time
+
+"""
+
+
+import logging
+
+from time import time
+from threading import Lock
+
+
+__all__ = [ 'RegisterShadow', 'VERIFY_POLICIES' ]
+
+
+VERIFY_POLICIES = ('always', 'sampled', 'never')
+REGISTER_MASK = 0xffffffff
+
+
+class RegisterShadow:
+    """ Wraps a board client (anything with regread/regwrite) and keeps the
+    last value written to, or read from, each register.
+
+    How writes are confirmed depends on the verify policy:
+
+        always  -- every write is read back from the board
+        sampled -- every verify_every-th write of each register is read back
+        never   -- writes are trusted, the shadow is only corrected by
+                   inst.reconcile()
+
+    A register read within max_age seconds of its last write or read comes
+    from the shadow, older ones (and registers never touched) are read from
+    the board. Values are kept as the unsigned 32 bit words the registers
+    hold."""
+
+    def __init__(self, board, verify='always', verify_every=8, max_age=60.0, name=None):
+        """ RegisterShadow(board, verify='always', verify_every=8, max_age=60.0) -> inst """
+        if verify not in VERIFY_POLICIES:
+            raise ValueError, "verify must be one of %s" % ', '.join(VERIFY_POLICIES)
+        if name is None:
+            name = getattr(board, 'logger', logging.getLogger('board')).name
+        self.logger = logging.getLogger('%s(%s)' % (self.__class__.__name__, name))
+        self.board = board
+        self.verify = verify
+        self.verify_every = max(1, verify_every)
+        self.max_age = max_age
+        self._lock = Lock()
+        self._values = {} # register: (value, time)
+        self._writes = {} # register: writes since the last read back
+        self.stats = dict.fromkeys(('reads', 'elided', 'writes', 'verified',
+                                    'divergences'), 0)
+
+    def _store(self, regname, value):
+        with self._lock:
+            self._values[regname] = (value, time())
+            self._writes[regname] = 0
+
+    def _compare(self, regname, expected, actual):
+        if actual is None: # the client gave up, keep what we have
+            self.logger.warning("could not read back %s" % regname)
+            return
+        if actual != expected:
+            self.logger.error("%s is %d on the board but %d in the shadow"
+                              % (regname, actual, expected))
+            with self._lock:
+                self.stats['divergences'] += 1
+        self._store(regname, actual)
+
+    def regread(self, regname):
+        """ inst.regread(regname) -> value
+        Returns the shadowed value if it is recent enough, otherwise reads
+        the register from the board."""
+        with self._lock:
+            value, when = self._values.get(regname, (None, 0))
+            if value is not None and time() - when < self.max_age:
+                self.stats['elided'] += 1
+                return value
+            self.stats['reads'] += 1
+        value = self.board.regread(regname)
+        if value is not None:
+            self._store(regname, value)
+        return value
+
+    def regwrite(self, regname, value):
+        """ inst.regwrite(regname, value) -> value
+        Writes the register and returns its value, read back from the board
+        if the verify policy asks for it."""
+        self.board.regwrite(regname, int(value))
+        value = int(value) & REGISTER_MASK
+        with self._lock:
+            self.stats['writes'] += 1
+            writes = self._writes.get(regname, 0) + 1
+            self._values[regname] = (value, time())
+            self._writes[regname] = writes
+            check = self.verify == 'always' or \
+                (self.verify == 'sampled' and writes >= self.verify_every)
+            if check:
+                self.stats['verified'] += 1
+        if check:
+            self._compare(regname, value, self.board.regread(regname))
+        return self._values[regname][0]
+
+    def invalidate(self, regname=None):
+        """ inst.invalidate(regname=None) -> None
+        Forgets one register (or all of them) so the next read goes to the
+        board, for registers changed behind the shadow's back."""
+        with self._lock:
+            if regname is None:
+                self._values.clear()
+                self._writes.clear()
+            else:
+                self._values.pop(regname, None)
+                self._writes.pop(regname, None)
+
+    def reconcile(self):
+        """ inst.reconcile() -> {regname: (shadow, board), ...}
+        Reads every shadowed register from the board, logs and corrects the
+        ones that diverged from the shadow and returns them."""
+        with self._lock:
+            shadowed = dict((r, v) for r, (v, t) in self._values.iteritems())
+        reads = getattr(self.board, 'regread_async', None)
+        if reads is not None: # queue them all before waiting on any
+            pending = [(r, reads(r)) for r in shadowed]
+            actual = dict((r, future.get()) for r, future in pending)
+        else:
+            actual = dict((r, self.board.regread(r)) for r in shadowed)
+        diverged = {}
+        for regname, value in actual.iteritems():
+            if value is not None and value != shadowed[regname]:
+                diverged[regname] = (shadowed[regname], value)
+            self._compare(regname, shadowed[regname], value)
+        return diverged
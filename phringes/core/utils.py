@@ -5,7 +5,8 @@ Common utilites for the PHRINGES system
 
 from numpy import (
     pi, ones, zeros, polyfit,
-    unwrap, linspace,
+    unwrap, linspace, dot,
+    empty, multiply, newaxis,
     )
 
 
@@ -27,3 +28,23 @@ def get_phase_fit(freq, phases, discont=pi):
     unwrapped = unwrap(phases, discont=discont)
     m, c = polyfit(freq, unwrapped, 1)
     return (m, c), m*freq + c
+
+
+def get_phase_fits(freq, phases, discont=pi, params=None, fits=None):
+    """ get_phase_fits(freq, phases) -> params, fits
+    Batched get_phase_fit, 'phases' has one row per baseline. All rows
+    are unwrapped at once and fitted with the closed-form least-squares
+    line, 'params' is (n, 2) holding each (slope, intercept) and 'fits'
+    has the same shape as 'phases'. Both are written in place if given."""
+    unwrapped = unwrap(phases, discont=discont, axis=-1)
+    centered = freq - freq.mean()
+    if params is None:
+        params = empty((len(unwrapped), 2))
+    if fits is None:
+        fits = empty(unwrapped.shape)
+    m = dot(unwrapped, centered) / dot(centered, centered)
+    c = unwrapped.mean(axis=-1) - m*freq.mean()
+    params[:, 0], params[:, 1] = m, c
+    multiply.outer(m, freq, out=fits)
+    fits += c[:, newaxis]
+    return params, fits
@@ -17,7 +17,7 @@ from numpy import (
     )
 
 import phringes.backends.sma as sma
-from phringes.backends.basic import NoCorrelations
+from phringes.backends.basic import NoCorrelations, BINARY_PACKET_VERSION
 from phringes.plotting.rtplot import RealTimePlot
 
 
@@ -36,7 +36,7 @@ frame.pack(fill=BOTH, expand=1)
 correlator = sma.BEE2CorrelatorClient(gethostbyname(gethostname()), 8332)
 server = sma.SubmillimeterArrayClient('128.171.116.126', 59998)
 try:
-    server.subscribe(correlator.host, correlator.port)
+    server.subscribe(correlator.host, correlator.port, BINARY_PACKET_VERSION)
 except:
     pass
 server.start_correlator()
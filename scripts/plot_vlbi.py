@@ -20,6 +20,10 @@ parser.add_option("--block", action="store",
                   help="start the correlator on BLOCK, can be 'high' or 'low' "
                   "(default 'high')",
                   metavar="BLOCK")
+parser.add_option("--multicast", action="store",
+                  dest="multicast", default=None,
+                  help="join the server's multicast GROUP:PORT instead of subscribing",
+                  metavar="GROUP:PORT")
 (options, args) = parser.parse_args()
 
 formatter = logging.Formatter('%(name)-32s: %(asctime)s : %(levelname)-8s %(message)s')
@@ -62,6 +66,11 @@ elif not options.remote and options.block=='low':
 else:
     raise ValueError, "Block option must be either 'high' or 'low'!"
 
+multicast_group = None
+if options.multicast and not options.remote:
+    multicast_group, sep, listen_port = options.multicast.partition(':')
+    listen_host, listen_port = '0.0.0.0', int(listen_port)
+
 
 from math import pi
 from time import time
@@ -72,7 +81,7 @@ from Tkinter import (
     Tk, StringVar, BooleanVar, Frame, LabelFrame, 
     Entry, OptionMenu, Label, Button, Checkbutton,
     TOP, BOTTOM, LEFT, RIGHT, BOTH,
-    N, S, E, W
+    N, S, E, W, READABLE,
     )
 
 from numpy.fft import fft
@@ -83,7 +92,7 @@ from numpy import (
     )
 
 import phringes.backends.sma as sma
-from phringes.backends.basic import NoCorrelations
+from phringes.backends.basic import NoCorrelations, BINARY_PACKET_VERSION
 from phringes.plotting.rtplot import RealTimePlot
 
 
@@ -123,11 +132,12 @@ server = sma.SubmillimeterArrayClient(server_host, server_port)
 if options.remote:
     client = server
 else:
-    client = sma.BEE2CorrelatorClient(listen_host, listen_port)
-try:
-    server.subscribe(listen_host, listen_port) # the server's local UDP client
-except:
-    pass
+    client = sma.BEE2CorrelatorClient(listen_host, listen_port, multicast_group=multicast_group)
+if multicast_group is None:
+    try:
+        server.subscribe(listen_host, listen_port, BINARY_PACKET_VERSION) # the server's local UDP client
+    except:
+        pass
 server.start_correlator()
 
 
@@ -159,7 +169,8 @@ plots.rowconfigure(1, weight=1)
 button_width = 8
 
 def quit_mon():
-    server.unsubscribe(listen_host, listen_port)
+    if multicast_group is None:
+        server.unsubscribe(listen_host, listen_port)
     server.stop_correlator()
     root.quit()
 
@@ -184,17 +195,13 @@ varsq = (3 + 2/3.)**2
 itime = server.get_integration_time()
 norm = (varsq * itime * 1.024*10**9) / 128.
 colors = ['b', 'g', 'r', 'c', 'm', 'y', 'k', 'w']
-def update_plots(widget, baselines, statusbar):
-    try:
-        corr_time, left, right, current, total, \
-            lag, visibility, phase_fit, delay, phase = client.get_correlation()
-        baseline = left, right
-        phases = angle(visibility)
-        residuals = phases - phase_fit
-        logger.debug('received baseline %s' % repr(baseline))
-    except NoCorrelations:
-        widget.after(1, update_plots, widget, baselines, statusbar)
-        return 
+def plot_correlation(widget, baselines, statusbar, correlation):
+    corr_time, left, right, current, total, \
+        lag, visibility, phase_fit, delay, phase = correlation
+    baseline = left, right
+    phases = angle(visibility)
+    residuals = phases - phase_fit
+    logger.debug('received baseline %s' % repr(baseline))
     if baseline not in baselines.keys():
         label_size = 'x-large'
         corr.axes.grid()
@@ -267,12 +274,34 @@ def update_plots(widget, baselines, statusbar):
         #root.geometry(window.winfo_geometry())
         #root.deiconify()
         #logger.info('update in')
+
+
+def update_plots(widget, baselines, statusbar):
+    """ Polls the server for correlations, only used when remote """
+    try:
+        correlation = client.get_correlation()
+    except NoCorrelations:
+        widget.after(1, update_plots, widget, baselines, statusbar)
+        return 
+    plot_correlation(widget, baselines, statusbar, correlation)
     widget.after_idle(update_plots, widget, baselines, statusbar)
 
 
+def receive_plots(widget, baselines, statusbar):
+    """ Called by Tk only when the UDP socket is readable """
+    for frame in client.get_frames():
+        for correlation in frame:
+            plot_correlation(widget, baselines, statusbar, correlation)
+
+
 root.update()
 root.geometry(window.winfo_geometry())
-root.after_idle(update_plots, root, {}, {})
+if options.remote:
+    root.after_idle(update_plots, root, {}, {})
+else:
+    plotted, statusbars = {}, {}
+    root.tk.createfilehandler(client.sock, READABLE,
+                              lambda sock, mask: receive_plots(root, plotted, statusbars))
 
 root.deiconify()
 root.mainloop()
@@ -9,6 +9,7 @@ import logging
 import logging.config
 from optparse import OptionParser
 
+from phringes.core.metrics import timings
 from phringes.backends.sma import (
     SubmillimeterArrayTCPServer
 )
@@ -50,6 +51,35 @@ parser.add_option("--dds-host", action="store",
                   dest="dds_host", default="128.171.116.189",
                   help="the DDS HOST, defaults to 'newdds'",
                   metavar="HOST")
+parser.add_option("--multicast", action="store",
+                  dest="multicast", default=None,
+                  help="also publish correlations to the multicast GROUP:PORT",
+                  metavar="GROUP:PORT")
+parser.add_option("--async", action="store_true",
+                  dest="use_async", default=False,
+                  help="handle all connections in one event loop instead of "
+                  "a thread per connection")
+parser.add_option("--workers", action="store", type="int",
+                  dest="workers", default=4,
+                  help="with --async, run hardware commands on N worker threads "
+                  "(0 runs them in the event loop), defaults to 4",
+                  metavar="N")
+parser.add_option("--verify", action="store", type="choice",
+                  choices=["always", "sampled", "never"],
+                  dest="verify", default="sampled",
+                  help="read register writes back from the iBOBs 'always', "
+                  "every few writes ('sampled') or 'never', defaults to 'sampled'",
+                  metavar="POLICY")
+parser.add_option("--verify-every", action="store", type="int",
+                  dest="verify_every", default=8,
+                  help="with --verify=sampled, read back every Nth write of "
+                  "a register, defaults to 8",
+                  metavar="N")
+parser.add_option("--timing", action="store", type="int",
+                  dest="timing", default=0,
+                  help="count the calls of every logged method and time one "
+                  "in N of them (0, the default, disables this)",
+                  metavar="N")
 (options, args) = parser.parse_args()
 
 
@@ -96,6 +126,15 @@ elif options.block=='low':
     dbe_host = 'dbelo'
     fstop = -0.256
 
+if options.multicast:
+    group, sep, group_port = options.multicast.partition(':')
+    multicast_group = (group, int(group_port))
+else:
+    multicast_group = None
+
+if options.timing:
+    timings.enable(sample=options.timing)
+
 HOST, PORT = options.host, options.port
 server = SubmillimeterArrayTCPServer((HOST, PORT), reference=options.reference, fstop=fstop,
                                      include_baselines=include_baselines, initial_int_time=1, 
@@ -103,11 +142,17 @@ server = SubmillimeterArrayTCPServer((HOST, PORT), reference=options.reference,
                                      correlator_bitstream=bee2_bitstream, ipa_hosts=ipa_hosts,
                                      dbe_host=dbe_host, dds_host=options.dds_host,
                                      correlator_client_port=correlator_client_port,
-                                     phase_tracker_port=phase_tracker_port)
+                                     phase_tracker_port=phase_tracker_port,
+                                     multicast_group=multicast_group,
+                                     register_verify=options.verify,
+                                     register_verify_every=options.verify_every)
 ip, port = server.server_address
 
 logger.info('starting server on port %d'%port)
-server.serve_forever()
+if options.use_async:
+    server.serve_async(workers=options.workers)
+else:
+    server.serve_forever()
 logger.info('exiting')
 if options.logfile:
     logfile.close()